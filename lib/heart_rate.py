@@ -0,0 +1,606 @@
+# heart_rate.py - Heart rate / SpO2 signal processing for the MAX30102
+# Pure Python (no machine imports) so the same code runs on the ESP32 and on
+# the host tools that reprocess recorded sessions.
+
+import math
+from array import array
+
+TICKS_MASK = 0x3FFFFFFF  # ticks_us() wraps at 2**30 on the ESP32
+
+try:
+    from time import ticks_diff
+except ImportError:
+    # Host: same wrap-aware semantics as MicroPython's ticks_diff
+    def ticks_diff(a, b):
+        return ((a - b + 0x20000000) & TICKS_MASK) - 0x20000000
+
+class HeartRateCalculator:
+    def __init__(self, sample_rate=100):
+        self.sample_rate = sample_rate
+        self.buffer_size = int(5 * sample_rate)  # 5 seconds of data
+        self.window = int(2 * sample_rate)       # 2 seconds analysed per call
+        self.min_distance = int(math.ceil(0.5 * sample_rate))  # 120 BPM max between peaks
+        self.ir_buffer = []
+        self.last_peak_time = 0
+        self.peak_intervals = []
+        self.max_intervals = 10
+        
+    def add_sample(self, ir_value):
+        """Add new IR sample to buffer"""
+        self.ir_buffer.append(ir_value)
+        if len(self.ir_buffer) > self.buffer_size:
+            self.ir_buffer.pop(0)
+    
+    def apply_bandpass_filter(self, data):
+        """Simple moving average filter to remove noise"""
+        if len(data) < 5:
+            return data
+            
+        filtered = []
+        window = 5
+        for i in range(len(data)):
+            start = max(0, i - window // 2)
+            end = min(len(data), i + window // 2 + 1)
+            filtered.append(sum(data[start:end]) / (end - start))
+        return filtered
+    
+    def find_peaks(self, data, min_distance=None):
+        """Find peaks in the signal with minimum distance constraint"""
+        if min_distance is None:
+            min_distance = self.min_distance
+        if len(data) < self.sample_rate:  # Need at least 1 second
+            return []
+            
+        # Apply simple filtering
+        filtered_data = self.apply_bandpass_filter(data)
+        
+        # Calculate dynamic threshold
+        mean_val = sum(filtered_data) / len(filtered_data)
+        std_dev = (sum([(x - mean_val) ** 2 for x in filtered_data]) / len(filtered_data)) ** 0.5
+        threshold = mean_val + 0.5 * std_dev
+        
+        peaks = []
+        last_peak_idx = -min_distance
+        
+        for i in range(1, len(filtered_data) - 1):
+            # Check if current point is a local maximum
+            if (filtered_data[i] > filtered_data[i-1] and 
+                filtered_data[i] > filtered_data[i+1] and 
+                filtered_data[i] > threshold and
+                i - last_peak_idx >= min_distance):
+                
+                peaks.append(i)
+                last_peak_idx = i
+                
+        return peaks
+    
+    def calculate_heart_rate(self):
+        """Calculate heart rate using improved peak detection"""
+        if len(self.ir_buffer) < self.window:  # Need at least 2 seconds of data
+            return 0
+            
+        # Find peaks in the IR signal
+        peaks = self.find_peaks(self.ir_buffer[-self.window:])  # Use last 2 seconds
+        
+        if len(peaks) < 2:
+            return 0
+            
+        # Calculate intervals between peaks
+        intervals = []
+        for i in range(1, len(peaks)):
+            interval = (peaks[i] - peaks[i-1]) / self.sample_rate  # Convert to seconds
+            # Filter out unrealistic intervals (30-200 BPM range)
+            if 0.3 <= interval <= 2.0:  # 30-200 BPM
+                intervals.append(interval)
+        
+        if not intervals:
+            return 0
+            
+        # Average the intervals and convert to BPM
+        avg_interval = sum(intervals) / len(intervals)
+        heart_rate = 60 / avg_interval
+        
+        # Additional filtering: maintain running average
+        self.peak_intervals.append(heart_rate)
+        if len(self.peak_intervals) > self.max_intervals:
+            self.peak_intervals.pop(0)
+            
+        # Return smoothed heart rate
+        return int(sum(self.peak_intervals) / len(self.peak_intervals))
+
+def check_finger_present(ir_data):
+    """Check if finger is present on sensor"""
+    if not ir_data or len(ir_data) < 10:
+        return False
+    avg_ir = sum(ir_data) / len(ir_data)
+    if avg_ir < 50000:
+        return False
+    mean_val = avg_ir
+    variance = sum([(x - mean_val) ** 2 for x in ir_data]) / len(ir_data)
+    std_dev = variance ** 0.5
+    return std_dev > 1000
+
+def calculate_spo2(red_data, ir_data):
+    """Improved SpO2 calculation"""
+    if not red_data or not ir_data or len(red_data) < 10:
+        return 0
+        
+    # Calculate AC and DC components for both signals
+    red_ac = max(red_data) - min(red_data)
+    red_dc = sum(red_data) / len(red_data)
+    ir_ac = max(ir_data) - min(ir_data)
+    ir_dc = sum(ir_data) / len(ir_data)
+    
+    # Avoid division by zero
+    if red_dc == 0 or ir_dc == 0 or ir_ac == 0:
+        return 0
+        
+    # Calculate R ratio
+    r_ratio = (red_ac / red_dc) / (ir_ac / ir_dc)
+    
+    # Improved SpO2 calculation (still simplified)
+    if r_ratio < 0.4:
+        spo2 = 100
+    elif r_ratio < 2.0:
+        spo2 = 110 - 25 * r_ratio
+    else:
+        spo2 = 60
+        
+    return min(100, max(85, spo2))  # Clamp to realistic range
+
+
+# Allocation-free versions used by the main.py loop. The functions above stay
+# as the readable reference (and what tools/reprocess.py verifies against).
+# MicroPython boxes every float on the heap, so these work on preallocated
+# array('i') buffers with small-int fixed-point math only. Values stay well
+# below 2**30; only a saturated/motion-corrupted signal can push an
+# intermediate into a heap-allocated big int.
+
+def _isqrt(n):
+    """Integer square root (Newton), no floats"""
+    if n <= 0:
+        return 0
+    x = n
+    y = (x + 1) // 2
+    while y < x:
+        x = y
+        y = (x + n // x) // 2
+    return x
+
+
+class FixedPointHeartRateCalculator:
+    """
+    Allocation-free HeartRateCalculator driven by per-sample timestamps
+    
+    sample_rate only sizes the buffers; peak spacing and beat intervals
+    are measured in ticks_us, so a changed FIFO rate, averaging setting or
+    dropped samples can't skew the BPM.
+    
+    With an HRVTracker, every beat is also passed on exactly once (windows
+    overlap, so peaks already seen in an earlier call are skipped). Beats go
+    over at a sub-sample time - the vertex of a parabola through the peak
+    and its neighbours - since at 25 Hz whole samples are 40 ms apart. Peaks
+    whose fit would touch the edge-truncated filter taps are left for the
+    next call, where they sit further inside the window.
+    """
+    def __init__(self, sample_rate=100, hrv=None):
+        self.sample_rate = sample_rate
+        self.hrv = hrv
+        self.buffer_size = int(5 * sample_rate)  # 5 seconds of data
+        self.window = int(2 * sample_rate)       # analysis window (2 seconds)
+        self.min_distance_us = 500000            # 120 BPM max between peaks
+        self.min_interval_us = 300000            # 200 BPM
+        self.max_interval_us = 2000000           # 30 BPM
+        self.max_intervals = 10
+        self._period_us = int(1000000 / sample_rate)
+        self._next_ts = 0
+        
+        buffer_size = self.buffer_size
+        window = self.window
+        self.ir_buffer = array('i', [0] * buffer_size)  # ring buffer
+        self.ts_buffer = array('i', [0] * buffer_size)  # ticks_us per sample
+        self.head = 0
+        self.count = 0
+        self._window = array('i', [0] * window)
+        self._window_ts = array('i', [0] * window)
+        self._filtered = array('i', [0] * window)     # (filtered - base) * 60
+        self._bpm = array('i', [0] * self.max_intervals)  # BPM * 100 ring
+        self._bpm_head = 0
+        self._bpm_count = 0
+        self._bpm_sum = 0
+        self._last_beat_ts = 0
+        self._last_beat_offset = 0  # us past _last_beat_ts, from the parabolic fit
+        self._have_beat = False
+        
+    def add_samples(self, buf, n, ts_buf=None):
+        """Add the first n samples of buf (timestamps from ts_buf, else nominal spacing)"""
+        for i in range(n):
+            self.ir_buffer[self.head] = buf[i]
+            if ts_buf is not None:
+                self._next_ts = ts_buf[i]
+            self.ts_buffer[self.head] = self._next_ts
+            self._next_ts = (self._next_ts + self._period_us) & TICKS_MASK
+            self.head += 1
+            if self.head == self.buffer_size:
+                self.head = 0
+        self.count = min(self.count + n, self.buffer_size)
+    
+    def calculate_heart_rate(self):
+        """Same steps as HeartRateCalculator.calculate_heart_rate, in integers"""
+        w = self.window
+        if self.count < w:
+            return 0
+        
+        # Copy the last window out of the ring, relative to its first sample
+        win = self._window
+        win_ts = self._window_ts
+        pos = (self.head - w) % self.buffer_size
+        for i in range(w):
+            win[i] = self.ir_buffer[pos]
+            win_ts[i] = self.ts_buffer[pos]
+            pos += 1
+            if pos == self.buffer_size:
+                pos = 0
+        base = win[0]
+        
+        # 5-tap moving average scaled by 60 (lcm of the 3/4/5-tap edge widths)
+        filtered = self._filtered
+        total = 0
+        for i in range(w):
+            lo = i - 2 if i >= 2 else 0
+            hi = i + 3 if i + 3 <= w else w
+            s = 0
+            for j in range(lo, hi):
+                s += win[j] - base
+            filtered[i] = s * (60 // (hi - lo))
+            total += filtered[i]
+        
+        # Dynamic threshold: mean + 0.5 * std
+        mean = total // w
+        var = 0
+        for i in range(w):
+            d = (filtered[i] - mean) // 60
+            var += d * d // w
+        threshold = mean + 30 * _isqrt(var)
+        
+        # Peaks with minimum spacing, accumulating 30-200 BPM intervals (us)
+        last_peak_ts = 0
+        have_peak = False
+        interval_sum = 0
+        interval_count = 0
+        for i in range(1, w - 1):
+            f = filtered[i]
+            if f > filtered[i - 1] and f > filtered[i + 1] and f > threshold:
+                d = ticks_diff(win_ts[i], last_peak_ts)
+                if have_peak and d < self.min_distance_us:
+                    continue
+                if have_peak and self.min_interval_us <= d <= self.max_interval_us:
+                    interval_sum += d
+                    interval_count += 1
+                last_peak_ts = win_ts[i]
+                have_peak = True
+                if self.hrv is not None and 3 <= i < w - 3:
+                    self._add_beat(last_peak_ts, self._peak_offset(i))
+        
+        if interval_count == 0:
+            return 0
+        
+        # Running average of the last max_intervals BPM values (x100),
+        # average interval taken in 10 us units to stay a small int
+        bpm = 600000000 // (interval_sum // (interval_count * 10))
+        if self._bpm_count == self.max_intervals:
+            self._bpm_sum -= self._bpm[self._bpm_head]
+        else:
+            self._bpm_count += 1
+        self._bpm[self._bpm_head] = bpm
+        self._bpm_sum += bpm
+        self._bpm_head = (self._bpm_head + 1) % self.max_intervals
+        return self._bpm_sum // (self._bpm_count * 100)
+    
+    def _peak_offset(self, i):
+        """us from sample i to the vertex of the parabola through filtered[i-1..i+1]"""
+        filtered = self._filtered
+        ts = self._window_ts
+        y0 = filtered[i - 1]
+        y1 = filtered[i]
+        y2 = filtered[i + 1]
+        # Vertex in 1/256 sample, |q| <= 128 as y1 is a strict local maximum
+        q = (y2 - y0) * 128 // (2 * y1 - y0 - y2)
+        if q >= 0:
+            return q * ticks_diff(ts[i + 1], ts[i]) // 256
+        return q * ticks_diff(ts[i], ts[i - 1]) // 256
+    
+    def _add_beat(self, ts, offset):
+        """Hand a beat newer than the last one handed over to the HRV tracker"""
+        if self._have_beat:
+            d = ticks_diff(ts, self._last_beat_ts) + offset - self._last_beat_offset
+            if d < self.min_distance_us:
+                return  # Same (or an older) beat, seen in an earlier window
+            self.hrv.add_interval(d // 1000)  # too long a gap is rejected there
+        self._last_beat_ts = ts
+        self._last_beat_offset = offset
+        self._have_beat = True
+
+
+class HRVTracker:
+    """
+    Streaming heart-rate variability over the last `window` accepted beats
+
+    RMSSD and pNN50 come from successive interval differences, SDNN from
+    the intervals themselves. add_interval() is O(1): running sums are
+    updated for the interval entering and the one leaving the window,
+    nothing is rescanned. Intervals are whole ms, summed relative to a
+    reference interval so the sums stay small ints.
+
+    An interval outside 300-2000 ms, or more than ECTOPIC_PCT off the
+    running mean, is an ectopic beat or a detection error: it is dropped
+    and the difference chain restarts after it. MAX_REJECTS in a row means
+    the rhythm itself changed, so the windows start over.
+    """
+    MIN_RR = 300        # ms, 200 BPM
+    MAX_RR = 2000       # ms, 30 BPM
+    ECTOPIC_PCT = 20
+    MAX_REJECTS = 5
+    NN50 = 50           # ms
+
+    def __init__(self, window=32, min_beats=8):
+        self.window = window
+        self.min_beats = min_beats  # differences needed before the metrics are reported
+        self._rr = array('i', [0] * window)      # interval - ref
+        self._sq = array('i', [0] * window)      # squared successive differences
+        self._nn50 = bytearray(window)           # 1 where |difference| > NN50
+        self.beats = 0      # accepted intervals (lifetime)
+        self.rejected = 0   # dropped intervals (lifetime)
+        self.reset()
+
+    def reset(self):
+        """Forget the windows (finger lifted, rhythm change)"""
+        self.ref = 0
+        self._rr_head = 0
+        self._rr_count = 0
+        self._rr_sum = 0
+        self._rr_sumsq = 0
+        self._sq_head = 0
+        self._sq_count = 0
+        self._sq_sum = 0
+        self._nn50_count = 0
+        self._prev = -1
+        self._rejects = 0
+
+    def add_interval(self, rr):
+        """Add one beat-to-beat interval in ms; False if rejected as ectopic/outlier"""
+        if rr < self.MIN_RR or rr > self.MAX_RR:
+            return self._reject()
+        if self._rr_count >= 4:
+            mean = self.ref + self._rr_sum // self._rr_count
+            d = rr - mean
+            if (d if d >= 0 else -d) * 100 > mean * self.ECTOPIC_PCT:
+                return self._reject()
+        self._rejects = 0
+        self.beats += 1
+
+        # Interval window (SDNN)
+        if self._rr_count == 0:
+            self.ref = rr
+        d = rr - self.ref
+        i = self._rr_head
+        if self._rr_count == self.window:
+            old = self._rr[i]
+            self._rr_sum -= old
+            self._rr_sumsq -= old * old
+        else:
+            self._rr_count += 1
+        self._rr[i] = d
+        self._rr_sum += d
+        self._rr_sumsq += d * d
+        self._rr_head = i + 1 if i + 1 < self.window else 0
+
+        # Successive-difference window (RMSSD, pNN50)
+        if self._prev >= 0:
+            diff = rr - self._prev
+            sq = diff * diff
+            nn50 = 1 if sq > self.NN50 * self.NN50 else 0
+            i = self._sq_head
+            if self._sq_count == self.window:
+                self._sq_sum -= self._sq[i]
+                self._nn50_count -= self._nn50[i]
+            else:
+                self._sq_count += 1
+            self._sq[i] = sq
+            self._nn50[i] = nn50
+            self._sq_sum += sq
+            self._nn50_count += nn50
+            self._sq_head = i + 1 if i + 1 < self.window else 0
+        self._prev = rr
+        return True
+
+    def _reject(self):
+        self.rejected += 1
+        self._prev = -1  # never difference across a dropped beat
+        self._rejects += 1
+        if self._rejects >= self.MAX_REJECTS:
+            self.reset()
+        return False
+
+    @property
+    def ready(self):
+        return self._sq_count >= self.min_beats
+
+    @property
+    def mean_rr(self):
+        """Mean interval in ms"""
+        if not self._rr_count:
+            return 0
+        return self.ref + self._rr_sum // self._rr_count
+
+    @property
+    def rmssd(self):
+        """Root mean square of successive differences, ms"""
+        if not self._sq_count:
+            return 0
+        return _isqrt(self._sq_sum // self._sq_count)
+
+    @property
+    def sdnn(self):
+        """Standard deviation of the intervals, ms"""
+        n = self._rr_count
+        if n < 2:
+            return 0
+        mean = self._rr_sum // n
+        return _isqrt((self._rr_sumsq - mean * self._rr_sum) // n)
+
+    @property
+    def pnn50(self):
+        """Percentage of successive differences above 50 ms"""
+        if not self._sq_count:
+            return 0
+        return self._nn50_count * 100 // self._sq_count
+
+
+def check_finger_present_buf(ir_buf, n):
+    """check_finger_present() on the first n samples of a preallocated buffer"""
+    if n < 10:
+        return False
+    total = 0
+    for i in range(n):
+        total += ir_buf[i]
+    if total < 50000 * n:
+        return False
+    # std > 1000  <=>  sum of squared deviations > 1000**2 * n
+    mean = total // n
+    limit = 1000000 * n
+    acc = 0
+    for i in range(n):
+        d = ir_buf[i] - mean
+        if d >= 32768 or d <= -32768:
+            return True
+        acc += d * d
+        if acc > limit:
+            return True
+    return False
+
+def calculate_spo2_tenths(red_buf, ir_buf, n):
+    """calculate_spo2() on preallocated buffers, in tenths of a percent"""
+    if n < 10:
+        return 0
+    red_min = red_max = red_sum = red_buf[0]
+    ir_min = ir_max = ir_sum = ir_buf[0]
+    for i in range(1, n):
+        r = red_buf[i]
+        x = ir_buf[i]
+        red_sum += r
+        ir_sum += x
+        if r < red_min:
+            red_min = r
+        elif r > red_max:
+            red_max = r
+        if x < ir_min:
+            ir_min = x
+        elif x > ir_max:
+            ir_max = x
+    
+    red_ac = red_max - red_min
+    ir_ac = ir_max - ir_min
+    # DC in 1/16 steps keeps q * dc inside small-int range
+    red_dc = (red_sum // n) >> 4
+    ir_dc = (ir_sum // n) >> 4
+    if red_dc == 0 or ir_dc == 0 or ir_ac == 0:
+        return 0
+    
+    # R ratio x1000 = (red_ac / ir_ac) * (ir_dc / red_dc)
+    r_ratio = (red_ac * 1000 // ir_ac) * ir_dc // red_dc
+    if r_ratio < 400:
+        spo2 = 1000
+    elif r_ratio < 2000:
+        spo2 = 1100 - r_ratio // 4
+    else:
+        spo2 = 600
+    
+    return min(1000, max(850, spo2))  # Clamp to realistic range
+
+
+class SignalQuality:
+    """
+    Cheap per-batch signal-quality index (0-100), fed sample by sample
+    while the FIFO is decoded
+
+    Three sub-scores, the worst one wins:
+      perfusion - IR AC/DC; a pulse too weak to see (or absurdly strong,
+                  which is motion) scores low
+      clipping  - samples pinned near the ADC limits
+      motion    - mean |second difference| against the pulse amplitude;
+                  a pulse is smooth, motion artifacts are jerky
+    """
+    ADC_MAX = 0x3FFFF
+    CLIP_LOW = 1024
+    CLIP_HIGH = 0x3FFFF - 1024
+    MIN_PERFUSION = 5       # per mille (0.5%) for a full perfusion score
+    MAX_PERFUSION = 200     # per mille (20%) - beyond this it's motion
+    MOTION_FREE = 15        # jerk ratio (%) at or below which motion scores 100
+
+    def __init__(self):
+        self.score = 0
+        self.perfusion = 0  # per mille
+        self.clipped = 0
+        self.motion = 0     # jerk ratio, %
+        self._prev1 = -1
+        self._prev2 = -1
+        self.begin()
+
+    def begin(self, lost=0):
+        """Start a new batch; lost samples break second-difference continuity"""
+        self._n = 0
+        self._total = 0
+        self._lo = self.ADC_MAX
+        self._hi = 0
+        self._clipped = 0
+        self._jerk = 0
+        self._jerk_n = 0
+        if lost:
+            self._prev1 = -1
+            self._prev2 = -1
+
+    def add(self, x):
+        self._n += 1
+        self._total += x
+        if x < self._lo:
+            self._lo = x
+        if x > self._hi:
+            self._hi = x
+        if x <= self.CLIP_LOW or x >= self.CLIP_HIGH:
+            self._clipped += 1
+        if self._prev2 >= 0:
+            j = x - 2 * self._prev1 + self._prev2
+            self._jerk += j if j >= 0 else -j
+            self._jerk_n += 1
+        self._prev2 = self._prev1
+        self._prev1 = x
+
+    def end(self):
+        """Finish the batch and return its score"""
+        n = self._n
+        if n == 0:
+            self.score = 0
+            return 0
+        ac = self._hi - self._lo
+        dc = self._total // n
+        self.clipped = self._clipped
+        self.perfusion = ac * 1000 // dc if dc else 0
+
+        if self.perfusion < self.MIN_PERFUSION:
+            perfusion_score = self.perfusion * 100 // self.MIN_PERFUSION
+        elif self.perfusion > self.MAX_PERFUSION:
+            perfusion_score = 30
+        else:
+            perfusion_score = 100
+
+        clip_score = 100 - self._clipped * 400 // n  # 25% clipped -> 0
+
+        self.motion = 0
+        if ac and self._jerk_n:
+            self.motion = (self._jerk // self._jerk_n) * 100 // ac
+        motion_score = 100 - (self.motion - self.MOTION_FREE) * 3 if self.motion > self.MOTION_FREE else 100
+
+        score = min(perfusion_score, clip_score, motion_score)
+        self.score = score if score > 0 else 0
+        return self.score
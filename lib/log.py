@@ -0,0 +1,150 @@
+# log.py - Buffered, leveled, rate-limited logging for the ESP32 main loop
+#
+# log() only does a level compare, an optional rate-limit lookup and a few
+# slot stores into a preallocated ring; nothing is formatted or printed
+# there. The level compare still runs after the arguments are evaluated, so
+# hot-path debug calls are wrapped in `if log.enabled(DEBUG):`.
+#
+# flush() formats at most `chunk` records per call (outside the sensing
+# path) and writes them to the console in one write, or hands them to a
+# structured sink such as the music server link.
+#
+# Messages are str.format templates with up to four positional arguments,
+# kept as-is in the ring until flush:
+#     log.info(K_READING, "❤️  HR: {} BPM | 🩸 SpO2: {}.{}%", hr, spo2 // 10, spo2 % 10)
+
+import sys
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return int(time.monotonic() * 1000) & 0x3FFFFFFF
+
+    def ticks_diff(a, b):
+        return a - b
+
+DEBUG = const(0)
+INFO = const(1)
+WARN = const(2)
+ERROR = const(3)
+LEVEL_NAMES = ('D', 'I', 'W', 'E')
+
+
+class Logger:
+    def __init__(self, level=INFO, capacity=32, chunk=8, sink=None, summary_ms=60000):
+        self.level = level
+        self.capacity = capacity
+        self.chunk = chunk
+        self.sink = sink  # None = console; callable(records) -> bool = structured
+        self.summary_ms = summary_ms  # minimum ms between rate-limit summaries
+        self._last_summary = ticks_ms()
+
+        # Ring of records, one preallocated slot per field
+        self._ticks = [0] * capacity
+        self._levels = bytearray(capacity)
+        self._keys = [None] * capacity
+        self._msgs = [None] * capacity
+        self._a = [None] * capacity
+        self._b = [None] * capacity
+        self._c = [None] * capacity
+        self._d = [None] * capacity
+        self.head = 0   # oldest record
+        self.count = 0
+        self.dropped = 0
+        self.suppressed = 0
+
+        self._intervals = {}  # key -> minimum ms between records
+        self._last = {}       # key -> ticks_ms of the last accepted record
+
+    def rate_limit(self, key, interval_ms):
+        """Accept at most one record per interval_ms for this key"""
+        self._intervals[key] = interval_ms
+
+    def enabled(self, level):
+        """Check before computing expensive log arguments"""
+        return level >= self.level
+
+    def log(self, level, key, msg, a=None, b=None, c=None, d=None):
+        if level < self.level:
+            return
+        now = ticks_ms()
+        interval = self._intervals.get(key)
+        if interval is not None:
+            last = self._last.get(key)
+            if last is not None and ticks_diff(now, last) < interval:
+                self.suppressed += 1
+                return
+            self._last[key] = now
+
+        if self.count == self.capacity:
+            # Full: overwrite the oldest record
+            i = self.head
+            self.head = (self.head + 1) % self.capacity
+            self.dropped += 1
+        else:
+            i = (self.head + self.count) % self.capacity
+            self.count += 1
+        self._ticks[i] = now
+        self._levels[i] = level
+        self._keys[i] = key
+        self._msgs[i] = msg
+        self._a[i] = a
+        self._b[i] = b
+        self._c[i] = c
+        self._d[i] = d
+
+    def debug(self, key, msg, a=None, b=None, c=None, d=None):
+        self.log(DEBUG, key, msg, a, b, c, d)
+
+    def info(self, key, msg, a=None, b=None, c=None, d=None):
+        self.log(INFO, key, msg, a, b, c, d)
+
+    def warn(self, key, msg, a=None, b=None, c=None, d=None):
+        self.log(WARN, key, msg, a, b, c, d)
+
+    def error(self, key, msg, a=None, b=None, c=None, d=None):
+        self.log(ERROR, key, msg, a, b, c, d)
+
+    def flush(self, max_records=None):
+        """Format and emit up to max_records (default: chunk) buffered records"""
+        n = min(self.count, self.chunk if max_records is None else max_records)
+        if n == 0:
+            return 0
+
+        records = []
+        for _ in range(n):
+            i = self.head
+            text = self._msgs[i].format(self._a[i], self._b[i], self._c[i], self._d[i])
+            records.append((self._ticks[i], self._levels[i], self._keys[i], text))
+            # Release argument references held by the slot
+            self._msgs[i] = self._a[i] = self._b[i] = self._c[i] = self._d[i] = None
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+
+        # Lost records are reported right away; rate limiting is expected and
+        # only summarised every summary_ms
+        now = ticks_ms()
+        if self.dropped or (self.suppressed and ticks_diff(now, self._last_summary) >= self.summary_ms):
+            records.append((now, WARN, 'log',
+                            f"⚠️  Log: {self.dropped} dropped, {self.suppressed} rate-limited"))
+            self.dropped = 0
+            self.suppressed = 0
+            self._last_summary = now
+
+        if self.sink is None or not self.sink(records):
+            sys.stdout.write('\n'.join(record[3] for record in records) + '\n')
+        return n
+
+    def flush_all(self):
+        """Drain the whole ring (shutdown / fatal error)"""
+        while self.count:
+            self.flush(self.capacity)
@@ -27,6 +27,76 @@ REG_PART_ID = 0xFF
 
 # Configuration constants
 FIFO_DEPTH = 32
+SHADOW_SIZE = REG_PROX_INT_THRESH + 1  # registers 0x00-0x30 are mirrored
+
+class SampleClock:
+    """
+    Reconstructs a ticks_us timestamp for every FIFO sample
+    
+    The newest sample of a drain was taken somewhere in the last sample
+    period before the pointers were read. The period is measured over a long
+    baseline of drains (so the sensor's own oscillator drift against the
+    ESP32 is tracked instead of assuming the nominal rate) and each drain
+    nudges the phase by 1/8 of its error to smooth out read jitter.
+    """
+    MIN_BASELINE = 256    # samples before the measured period is trusted
+    MAX_BASELINE = 4096   # re-reference so ticks differences stay small ints
+    
+    def __init__(self, sample_rate, sample_avg=1):
+        self.reset(sample_rate, sample_avg)
+        
+    def reset(self, sample_rate, sample_avg=1):
+        # Sample period in 1/256 us
+        self.nominal_q8 = (256000000 * sample_avg) // sample_rate
+        self.period_q8 = self.nominal_q8
+        self.index = 0          # index of the next sample to be stamped
+        self.anchor_index = -1  # sample index whose time is anchor_ticks
+        self.anchor_ticks = 0
+        self.ref_index = -1     # start of the period-measurement baseline
+        self.ref_ticks = 0
+        
+    @property
+    def period_us(self):
+        return self.period_q8 >> 8
+        
+    def _rebase(self, index, ticks):
+        self.anchor_index = self.ref_index = index
+        self.anchor_ticks = self.ref_ticks = ticks
+        
+    def stamp(self, ts_buf, lost, count, read_ticks):
+        """Fill ts_buf[:count] for a drain of count samples after lost overflowed ones"""
+        self.index += lost
+        newest = self.index + count - 1
+        observed = time.ticks_add(read_ticks, -(self.period_q8 >> 9))  # mid of last period
+        span = newest - self.anchor_index
+        
+        if self.anchor_index < 0 or span > 2 * FIFO_DEPTH:
+            # First drain, or too long since the last one to trust the model
+            self._rebase(newest, observed)
+        else:
+            predicted = time.ticks_add(self.anchor_ticks, (span * self.period_q8) >> 8)
+            error = time.ticks_diff(observed, predicted)
+            if error > 4 * (self.period_q8 >> 8) or error < -4 * (self.period_q8 >> 8):
+                # Lost more than the saturated overflow counter could tell us
+                self._rebase(newest, observed)
+            else:
+                self.anchor_index = newest
+                self.anchor_ticks = time.ticks_add(predicted, error >> 3)
+                
+                baseline = newest - self.ref_index
+                if baseline >= self.MIN_BASELINE:
+                    elapsed = time.ticks_diff(observed, self.ref_ticks)
+                    measured = ((elapsed // baseline) << 8) + ((elapsed % baseline) << 8) // baseline
+                    # Only accept rates within 5% of the configured one
+                    if abs(measured - self.nominal_q8) <= self.nominal_q8 // 20:
+                        self.period_q8 += (measured - self.period_q8) >> 2
+                    if baseline >= self.MAX_BASELINE:
+                        self.ref_index = self.anchor_index
+                        self.ref_ticks = self.anchor_ticks
+        
+        for i in range(count):
+            ts_buf[i] = time.ticks_add(self.anchor_ticks, -(((count - 1 - i) * self.period_q8) >> 8))
+        self.index += count
 
 class MAX30102:
     def __init__(self, i2c, addr=0x57):
@@ -34,6 +104,34 @@ class MAX30102:
         self.addr = addr
         self.red_led_current = 0x1F  # Default LED current
         self.ir_led_current = 0x1F
+        self.led_mode = 2
+        self.sample_rate = 100
+        self.sample_avg = 4
+        self.pulse_width = 411
+        self.adc_range = 4096
+        self.clock = SampleClock(self.sample_rate, self.sample_avg)
+        self.last_overflow = 0   # samples lost before the last drain
+        self.samples_lost = 0
+        self.samples_read = 0
+        
+        # I2C transaction counters (reset_counters() to start a measurement)
+        self.i2c_reads = 0
+        self.i2c_writes = 0
+        self.i2c_errors = 0      # failed FIFO reads (never printed: may run on the acquisition thread)
+        self.last_i2c_error = None
+        
+        # Shadow of the configuration registers: every write goes through it,
+        # so read-modify-write never has to read the bus. Status, FIFO pointer
+        # and self-clearing bits are always read from the device.
+        self._shadow = bytearray(SHADOW_SIZE)
+        
+        # Preallocated I2C buffers so steady-state reads don't touch the heap
+        self._reg_buf = bytearray(1)
+        self._ptr_buf = bytearray(3)   # WR_PTR, OVF_COUNTER, RD_PTR
+        self._pair_buf = bytearray(2)  # INTR_STATUS_1/2, TEMP_INTR/FRAC
+        self._fifo_buf = bytearray(6 * FIFO_DEPTH)
+        fifo_view = memoryview(self._fifo_buf)
+        self._fifo_views = [fifo_view[:6 * n] for n in range(FIFO_DEPTH + 1)]
         
         # Verify device presence
         if not self._check_device():
@@ -64,8 +162,12 @@ class MAX30102:
             
         if timeout <= 0:
             raise RuntimeError("Device reset timeout")
+        
+        # All configuration registers power up as 0x00
+        for i in range(SHADOW_SIZE):
+            self._shadow[i] = 0
             
-    def setup(self, led_mode=2, sample_rate=100, pulse_width=411, adc_range=4096):
+    def setup(self, led_mode=2, sample_rate=100, pulse_width=411, adc_range=4096, sample_avg=4):
         """
         Configure sensor for HR and SpO2 reading
         
@@ -74,46 +176,60 @@ class MAX30102:
             sample_rate: 50, 100, 200, 400, 800, 1000, 1600, 3200 Hz
             pulse_width: 69, 118, 215, 411 μs
             adc_range: 2048, 4096, 8192, 16384 nA
+            sample_avg: 1, 2, 4, 8, 16, 32 ADC samples averaged per FIFO sample
         """
         
-        # Clear any existing interrupts
-        self._read_reg(REG_INTR_STATUS_1)
-        self._read_reg(REG_INTR_STATUS_2)
+        # Clear any existing interrupts (both status registers in one read)
+        self._read_regs_into(REG_INTR_STATUS_1, self._pair_buf)
         
         # FIFO Configuration
         # Bit 7:5 - Sample Averaging (000 = no averaging, 001 = 2, 010 = 4, 011 = 8, 100 = 16, 101 = 32)
         # Bit 4 - FIFO Rollover Enable (1 = allow rollover)
         # Bit 3:0 - FIFO Almost Full Value (0x0F = interrupt when 17 samples remain)
-        fifo_config = (0x02 << 5) | (1 << 4) | 0x0F  # 4 sample averaging, rollover enabled
-        self._write_reg(REG_FIFO_CONFIG, fifo_config)
+        sample_avg_map = {1: 0, 2: 1, 4: 2, 8: 3, 16: 4, 32: 5}
+        if sample_avg not in sample_avg_map:
+            sample_avg = 4
+        fifo_config = (sample_avg_map[sample_avg] << 5) | (1 << 4) | 0x0F  # rollover enabled
+        self.sample_avg = sample_avg
         
         # Mode Configuration
         # Bit 6 - Reset (0 = normal operation)
         # Bit 3 - Shutdown (0 = normal operation) 
         # Bit 2:0 - Mode (001 = Heart Rate, 010 = SpO2, 011 = Multi-LED)
         mode_config = led_mode
-        self._write_reg(REG_MODE_CONFIG, mode_config)
+        self.led_mode = led_mode
         
         # SpO2 Configuration
         spo2_config = self._encode_spo2_config(adc_range, sample_rate, pulse_width)
-        self._write_reg(REG_SPO2_CONFIG, spo2_config)
+        self.sample_rate = sample_rate
+        self.pulse_width = pulse_width
+        self.adc_range = adc_range
+        
+        # FIFO_CONFIG, MODE_CONFIG and SPO2_CONFIG are adjacent: one burst
+        self._write_regs(REG_FIFO_CONFIG, bytes((fifo_config, mode_config, spo2_config)))
         
-        # LED Pulse Amplitude Configuration
-        self._write_reg(REG_LED1_PA, self.red_led_current)  # Red LED
-        self._write_reg(REG_LED2_PA, self.ir_led_current)   # IR LED
+        # LED Pulse Amplitude Configuration (Red LED, IR LED)
+        self._write_regs(REG_LED1_PA, bytes((self.red_led_current, self.ir_led_current)))
         
         # Multi-LED Mode Control (if using mode 3)
         if led_mode == 3:
-            self._write_reg(REG_MULTI_LED_CTRL1, 0x21)  # Slot 1: Red, Slot 2: IR
-            self._write_reg(REG_MULTI_LED_CTRL2, 0x00)  # Slot 3: None, Slot 4: None
+            # Slot 1: Red, Slot 2: IR / Slot 3: None, Slot 4: None
+            self._write_regs(REG_MULTI_LED_CTRL1, bytes((0x21, 0x00)))
             
-        # Clear FIFO pointers
-        self._write_reg(REG_FIFO_WR_PTR, 0x00)
-        self._write_reg(REG_OVF_COUNTER, 0x00)
-        self._write_reg(REG_FIFO_RD_PTR, 0x00)
+        self.clear_fifo()
+        
+        self.clock.reset(sample_rate, sample_avg)
+        self.last_overflow = 0
+        self.samples_lost = 0
+        self.samples_read = 0
         
         time.sleep_ms(100)  # Allow configuration to settle
         
+    @property
+    def effective_sample_rate(self):
+        """FIFO output rate in Hz: ADC rate divided by sample averaging"""
+        return self.sample_rate // self.sample_avg
+        
     def _encode_spo2_config(self, adc_range, sample_rate, pulse_width):
         """Encode SpO2 configuration register"""
         # ADC Range encoding
@@ -134,17 +250,33 @@ class MAX30102:
         """Set LED current (0-255, where 255 = 51mA)"""
         if red_current is not None:
             self.red_led_current = min(255, max(0, red_current))
-            self._write_reg(REG_LED1_PA, self.red_led_current)
             
         if ir_current is not None:
             self.ir_led_current = min(255, max(0, ir_current))
-            self._write_reg(REG_LED2_PA, self.ir_led_current)
+        
+        # LED1_PA and LED2_PA are adjacent; unchanged values aren't rewritten
+        if red_current is not None and ir_current is not None:
+            if (self._shadow[REG_LED1_PA] != self.red_led_current or
+                    self._shadow[REG_LED2_PA] != self.ir_led_current):
+                self._write_regs(REG_LED1_PA, bytes((self.red_led_current, self.ir_led_current)))
+        elif red_current is not None:
+            self._update_reg(REG_LED1_PA, 0xFF, self.red_led_current)
+        elif ir_current is not None:
+            self._update_reg(REG_LED2_PA, 0xFF, self.ir_led_current)
             
     def get_fifo_available(self):
-        """Get number of available samples in FIFO"""
-        wr_ptr = self._read_reg(REG_FIFO_WR_PTR) & 0x1F
-        rd_ptr = self._read_reg(REG_FIFO_RD_PTR) & 0x1F
+        """Get number of available samples in FIFO (also latches last_overflow)"""
+        # WR_PTR, OVF_COUNTER and RD_PTR are adjacent: one 3-byte read. The
+        # overflow counter resets once a sample is popped, so it is read here,
+        # before draining.
+        ptrs = self._ptr_buf
+        self._read_regs_into(REG_FIFO_WR_PTR, ptrs)
+        wr_ptr = ptrs[0] & 0x1F
+        self.last_overflow = ptrs[1] & 0x1F
+        rd_ptr = ptrs[2] & 0x1F
         
+        if self.last_overflow and wr_ptr == rd_ptr:
+            return FIFO_DEPTH  # Full and rolling over, not empty
         if wr_ptr >= rd_ptr:
             return wr_ptr - rd_ptr
         else:
@@ -175,6 +307,7 @@ class MAX30102:
             try:
                 # Each sample is 6 bytes (3 bytes per LED, 18-bit resolution)
                 data = self.i2c.readfrom_mem(self.addr, REG_FIFO_DATA, 6)
+                self.i2c_reads += 1
                 
                 # Extract 18-bit values and mask unused bits
                 red_value = ((data[0] << 16) | (data[1] << 8) | data[2]) & 0x3FFFF
@@ -184,13 +317,69 @@ class MAX30102:
                 ir_data.append(ir_value)
                 
             except Exception as e:
-                print(f"FIFO read error: {e}")
+                self.i2c_errors += 1
+                self.last_i2c_error = e
                 break
                 
         return red_data, ir_data
         
+    def read_sensor_into(self, red_buf, ir_buf, ts_buf=None, quality=None):
+        """
+        Allocation-free read_sensor(): burst-read the FIFO into preallocated buffers
+        
+        Args:
+            red_buf, ir_buf: array('i') of at least FIFO_DEPTH entries
+            ts_buf: optional array('i') receiving each sample's ticks_us timestamp
+            quality: optional SignalQuality fed each IR sample as it is decoded
+            
+        Returns:
+            int: number of samples written to the buffers
+        """
+        read_ticks = time.ticks_us()
+        available = self.get_fifo_available()
+        lost = self.last_overflow
+        self.samples_lost += lost
+        if available == 0:
+            return 0
+        available = min(available, len(ir_buf))
+        
+        # FIFO_DATA doesn't auto-increment, so one burst pops `available` samples
+        data = self._fifo_views[available]
+        try:
+            self.i2c.readfrom_mem_into(self.addr, REG_FIFO_DATA, data)
+        except Exception as e:
+            self.i2c_errors += 1
+            self.last_i2c_error = e
+            # Keep the timestamp model in step with the overflowed samples
+            self.clock.index += lost
+            return 0
+        self.i2c_reads += 1
+            
+        if quality is not None:
+            quality.begin(lost)
+        for i in range(available):
+            j = 6 * i
+            red_buf[i] = ((data[j] << 16) | (data[j + 1] << 8) | data[j + 2]) & 0x3FFFF
+            ir_buf[i] = ((data[j + 3] << 16) | (data[j + 4] << 8) | data[j + 5]) & 0x3FFFF
+            if quality is not None:
+                quality.add(ir_buf[i])
+        if quality is not None:
+            quality.end()
+        
+        self.samples_read += available
+        if ts_buf is not None:
+            self.clock.stamp(ts_buf, lost, available, read_ticks)
+        return available
+        
     def read_temperature(self):
         """Read temperature from sensor"""
+        raw = self.read_temperature_raw()
+        if raw is None:
+            return None
+        return raw * 0.0625
+        
+    def read_temperature_raw(self):
+        """Read temperature in 1/16 °C steps as an int (no float allocation)"""
         # Enable temperature measurement
         self._write_reg(REG_TEMP_CONFIG, 0x01)
         
@@ -202,36 +391,47 @@ class MAX30102:
             time.sleep_ms(10)
             timeout -= 1
             
+        # TEMP_EN clears itself when the conversion is done
+        self._shadow[REG_TEMP_CONFIG] = 0
         if timeout <= 0:
             return None
             
-        # Read temperature registers
-        temp_int = self._read_reg(REG_TEMP_INTR)
-        temp_frac = self._read_reg(REG_TEMP_FRAC)
+        # Read temperature registers (integer and fraction in one read)
+        self._read_regs_into(REG_TEMP_INTR, self._pair_buf)
+        temp_int = self._pair_buf[0]
+        temp_frac = self._pair_buf[1]
         
         # Handle signed integer part
         if temp_int > 127:
             temp_int = temp_int - 256
             
-        # Calculate final temperature
-        temperature = temp_int + (temp_frac * 0.0625)
-        return temperature
+        # Fraction register counts 0.0625 °C steps
+        return temp_int * 16 + (temp_frac & 0x0F)
         
     def clear_fifo(self):
         """Clear FIFO buffer"""
-        self._write_reg(REG_FIFO_WR_PTR, 0x00)
-        self._write_reg(REG_OVF_COUNTER, 0x00)
-        self._write_reg(REG_FIFO_RD_PTR, 0x00)
+        # WR_PTR, OVF_COUNTER and RD_PTR in one burst
+        ptrs = self._ptr_buf
+        ptrs[0] = ptrs[1] = ptrs[2] = 0
+        self._write_regs(REG_FIFO_WR_PTR, ptrs)
         
     def shutdown(self):
         """Put device in shutdown mode to save power"""
-        mode_config = self._read_reg(REG_MODE_CONFIG)
-        self._write_reg(REG_MODE_CONFIG, mode_config | 0x80)
+        self._update_reg(REG_MODE_CONFIG, 0x80, 0x80)
         
     def wakeup(self):
         """Wake device from shutdown mode"""
-        mode_config = self._read_reg(REG_MODE_CONFIG)
-        self._write_reg(REG_MODE_CONFIG, mode_config & 0x7F)
+        self._update_reg(REG_MODE_CONFIG, 0x80, 0x00)
+        
+    def reset_counters(self):
+        """Zero the I2C transaction counters"""
+        self.i2c_reads = 0
+        self.i2c_writes = 0
+        self.i2c_errors = 0
+        
+    @property
+    def i2c_transactions(self):
+        return self.i2c_reads + self.i2c_writes
         
     def get_part_id(self):
         """Get device part ID"""
@@ -244,20 +444,53 @@ class MAX30102:
     def _write_reg(self, reg_addr, data):
         """Write data to register"""
         try:
-            self.i2c.writeto_mem(self.addr, reg_addr, bytes([data]))
+            self._reg_buf[0] = data
+            self.i2c.writeto_mem(self.addr, reg_addr, self._reg_buf)
+        except Exception as e:
+            raise RuntimeError(f"I2C write error: {e}")
+        self.i2c_writes += 1
+        if reg_addr < SHADOW_SIZE:
+            self._shadow[reg_addr] = data
+            
+    def _write_regs(self, reg_addr, data):
+        """Burst-write consecutive registers starting at reg_addr"""
+        try:
+            self.i2c.writeto_mem(self.addr, reg_addr, data)
         except Exception as e:
             raise RuntimeError(f"I2C write error: {e}")
+        self.i2c_writes += 1
+        for i in range(len(data)):
+            if reg_addr + i < SHADOW_SIZE:
+                self._shadow[reg_addr + i] = data[i]
+                
+    def _update_reg(self, reg_addr, mask, bits):
+        """Read-modify-write from the shadow copy; no bus read, no write if unchanged"""
+        value = (self._shadow[reg_addr] & ~mask) | (bits & mask)
+        if value != self._shadow[reg_addr]:
+            self._write_reg(reg_addr, value)
             
     def _read_reg(self, reg_addr):
         """Read data from register"""
         try:
-            return self.i2c.readfrom_mem(self.addr, reg_addr, 1)[0]
+            self.i2c.readfrom_mem_into(self.addr, reg_addr, self._reg_buf)
         except Exception as e:
             raise RuntimeError(f"I2C read error: {e}")
+        self.i2c_reads += 1
+        return self._reg_buf[0]
+            
+    def _read_regs_into(self, reg_addr, buf):
+        """Burst-read consecutive registers starting at reg_addr into buf"""
+        try:
+            self.i2c.readfrom_mem_into(self.addr, reg_addr, buf)
+        except Exception as e:
+            raise RuntimeError(f"I2C multi-read error: {e}")
+        self.i2c_reads += 1
             
     def _read_multi_reg(self, reg_addr, length):
         """Read multiple registers"""
         try:
-            return self.i2c.readfrom_mem(self.addr, reg_addr, length)
+            data = self.i2c.readfrom_mem(self.addr, reg_addr, length)
         except Exception as e:
-            raise RuntimeError(f"I2C multi-read error: {e}")
\ No newline at end of file
+            raise RuntimeError(f"I2C multi-read error: {e}")
+        self.i2c_reads += 1
+        return data
\ No newline at end of file
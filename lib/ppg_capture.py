@@ -0,0 +1,147 @@
+# ppg_capture.py - Compact raw PPG capture file writer (.ppg)
+# Runs on the ESP32; tools/ppg_reader.py reads the files back on the PC.
+#
+# File layout (all little endian):
+#
+#   Header (HEADER_SIZE bytes, HEADER_FORMAT)
+#     magic 'PPGC', version, led_mode, sample_avg, reserved,
+#     sample_rate_mhz (ADC rate in milli-Hz), pulse_width (us), adc_range (nA),
+#     red_current, ir_current, part_id, revision_id,
+#     sensor_id (8 bytes), start_time (RTC seconds when the capture began)
+#
+#   Chunks, repeated (CHUNK_HEADER_FORMAT followed by payload_len bytes)
+#     magic 'CK', sample count, payload_len,
+#     t0 (us since capture start), red0, ir0  -- first sample stored raw
+#     payload: for every further sample three zigzag varints
+#       dod_t  change of the sample interval (us) vs. the previous interval,
+#              which starts at the nominal period, so regular sampling is 0
+#       d_red  red delta vs. previous sample
+#       d_ir   IR delta vs. previous sample
+#
+# 18-bit samples move by a few hundred counts between readings, so a sample
+# normally costs 3-5 bytes instead of ~40 in JSON.
+
+import struct
+import time
+
+try:
+    from time import ticks_diff
+except ImportError:
+    def ticks_diff(a, b):
+        return a - b
+
+MAGIC = b'PPGC'
+CHUNK_MAGIC = b'CK'
+VERSION = 1
+HEADER_FORMAT = '<4sBBBBIHHBBBB8sI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+CHUNK_HEADER_FORMAT = '<2sHIQII'
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_HEADER_FORMAT)
+DEFAULT_CHUNK_SAMPLES = 256
+
+
+def nominal_period_us(sample_rate, sample_avg):
+    """Microseconds between FIFO samples for an ADC rate and averaging"""
+    return int(1000000 * sample_avg / sample_rate + 0.5)
+
+
+def _put_varint(buf, value):
+    """Append a zigzag-encoded signed varint"""
+    value = value << 1 if value >= 0 else ((-value) << 1) - 1
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+class PPGCaptureWriter:
+    def __init__(self, path, sample_rate=100, led_mode=2, sample_avg=1, pulse_width=411,
+                 adc_range=4096, red_current=0, ir_current=0, part_id=0, revision_id=0,
+                 sensor_id=b'', start_time=0, chunk_samples=DEFAULT_CHUNK_SAMPLES):
+        self.chunk_samples = chunk_samples
+        self.period_us = nominal_period_us(sample_rate, sample_avg)
+        self.samples_written = 0
+        self.bytes_written = HEADER_SIZE
+
+        self._file = open(path, 'wb')
+        self._file.write(struct.pack(
+            HEADER_FORMAT, MAGIC, VERSION, led_mode, sample_avg, 0,
+            int(sample_rate * 1000), pulse_width, adc_range,
+            red_current, ir_current, part_id, revision_id,
+            bytes(sensor_id)[:8], start_time))
+
+        self._payload = bytearray()
+        self._count = 0
+        self._t0 = 0
+        self._red0 = 0
+        self._ir0 = 0
+        self._last_ticks = None
+        self._elapsed_us = 0
+        self._last_t = 0
+        self._last_dt = 0
+        self._last_red = 0
+        self._last_ir = 0
+
+    @classmethod
+    def for_sensor(cls, path, sensor, sensor_id=b'', chunk_samples=DEFAULT_CHUNK_SAMPLES):
+        """Create a writer whose header describes a configured MAX30102"""
+        return cls(path, sample_rate=sensor.sample_rate, led_mode=sensor.led_mode,
+                   sample_avg=sensor.sample_avg, pulse_width=sensor.pulse_width,
+                   adc_range=sensor.adc_range, red_current=sensor.red_led_current,
+                   ir_current=sensor.ir_led_current, part_id=sensor.get_part_id(),
+                   revision_id=sensor.get_revision_id(), sensor_id=sensor_id,
+                   start_time=int(time.time()), chunk_samples=chunk_samples)
+
+    def write_sample(self, ticks_us, red, ir):
+        """Append one sample taken at time.ticks_us() value ticks_us"""
+        if self._last_ticks is not None:
+            self._elapsed_us += ticks_diff(ticks_us, self._last_ticks)
+        self._last_ticks = ticks_us
+        t = self._elapsed_us
+
+        if self._count == 0:
+            self._t0 = t
+            self._red0 = red
+            self._ir0 = ir
+            self._last_dt = self.period_us
+        else:
+            dt = t - self._last_t
+            _put_varint(self._payload, dt - self._last_dt)
+            _put_varint(self._payload, red - self._last_red)
+            _put_varint(self._payload, ir - self._last_ir)
+            self._last_dt = dt
+
+        self._last_t = t
+        self._last_red = red
+        self._last_ir = ir
+        self._count += 1
+        if self._count >= self.chunk_samples:
+            self._flush_chunk()
+
+    def write_samples(self, red_buf, ir_buf, ts_buf, count):
+        """Append count samples with their reconstructed ticks_us timestamps"""
+        for i in range(count):
+            self.write_sample(ts_buf[i], red_buf[i], ir_buf[i])
+
+    def _flush_chunk(self):
+        if self._count == 0:
+            return
+        self._file.write(struct.pack(CHUNK_HEADER_FORMAT, CHUNK_MAGIC, self._count,
+                                     len(self._payload), self._t0, self._red0, self._ir0))
+        self._file.write(self._payload)
+        self.samples_written += self._count
+        self.bytes_written += CHUNK_HEADER_SIZE + len(self._payload)
+        self._payload = bytearray()
+        self._count = 0
+
+    def flush(self):
+        """Write the pending partial chunk and flush the file"""
+        self._flush_chunk()
+        self._file.flush()
+
+    def close(self):
+        """Flush and close the capture file"""
+        if self._file:
+            self.flush()
+            self._file.close()
+            self._file = None
@@ -0,0 +1,50 @@
+# ring.py - Lock-free single-producer/single-consumer ring of int records
+#
+# Every record is `fields` ints stored in one preallocated array('i'). Only
+# the producer moves `head` and only the consumer moves `tail`, and each side
+# writes its index after the record data, so the two threads never need a
+# lock and push/pop never allocate.
+
+from array import array
+
+
+class RecordRing:
+    def __init__(self, capacity, fields):
+        if capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two")
+        self.capacity = capacity
+        self.fields = fields
+        self._mask = capacity - 1
+        self._data = array('i', [0] * (capacity * fields))
+        self.head = 0     # next slot to write (producer only)
+        self.tail = 0     # next slot to read (consumer only)
+        self.dropped = 0  # records the producer couldn't fit (producer only)
+
+    def __len__(self):
+        return (self.head - self.tail) & 0x3FFFFFFF
+
+    def reserve(self):
+        """Producer: offset of a free record in .buffer, or -1 when full"""
+        if ((self.head - self.tail) & 0x3FFFFFFF) >= self.capacity:
+            self.dropped += 1
+            return -1
+        return (self.head & self._mask) * self.fields
+
+    def commit(self):
+        """Producer: publish the record filled in after reserve()"""
+        self.head = (self.head + 1) & 0x3FFFFFFF
+
+    def pop_into(self, record):
+        """Consumer: copy the oldest record into record (array of fields); False if empty"""
+        if self.tail == self.head:
+            return False
+        base = (self.tail & self._mask) * self.fields
+        data = self._data
+        for i in range(self.fields):
+            record[i] = data[base + i]
+        self.tail = (self.tail + 1) & 0x3FFFFFFF
+        return True
+
+    @property
+    def buffer(self):
+        return self._data
@@ -1,22 +1,46 @@
 # main.py for ESP32 - WiFi Heart Rate Music System with Enhanced Debugging
 # Upload this to your ESP32 using Thonny or similar
 
-from machine import Pin, SoftI2C
+from machine import Pin, SoftI2C, unique_id
 import json
 import time
 import network
 import socket
 import gc
+import errno
+from array import array
 try:
-    from lib.max30102_corrected import MAX30102  # Try from lib folder first
+    from lib.max30102_corrected import MAX30102, FIFO_DEPTH  # Try from lib folder first
 except ImportError:
     try:
-        from max30102_corrected import MAX30102  # Try from root folder
+        from max30102_corrected import MAX30102, FIFO_DEPTH  # Try from root folder
     except ImportError:
         print("❌ MAX30102 library not found!")
         print("🔧 Make sure max30102_corrected.py is uploaded to ESP32")
         print("📁 Check file location: /lib/max30102_corrected.py or /max30102_corrected.py")
         raise
+try:
+    from lib.heart_rate import (FixedPointHeartRateCalculator, HRVTracker, SignalQuality,
+                                check_finger_present_buf, calculate_spo2_tenths)
+except ImportError:
+    from heart_rate import (FixedPointHeartRateCalculator, HRVTracker, SignalQuality,
+                            check_finger_present_buf, calculate_spo2_tenths)
+try:
+    from lib.ppg_capture import PPGCaptureWriter
+except ImportError:
+    from ppg_capture import PPGCaptureWriter
+try:
+    from lib.log import Logger, DEBUG as LOG_DEBUG, INFO as LOG_INFO
+except ImportError:
+    from log import Logger, DEBUG as LOG_DEBUG, INFO as LOG_INFO
+try:
+    from lib.ring import RecordRing
+except ImportError:
+    from ring import RecordRing
+try:
+    import _thread
+except ImportError:
+    _thread = None  # Port built without threads: acquisition runs in the main loop
 
 # WiFi Configuration - VERIFY THESE ARE CORRECT!
 WIFI_SSID = "corona_yahi_hai"        # Your WiFi name
@@ -24,9 +48,95 @@ WIFI_PASSWORD = "madRascals@300125"       # Your WiFi password
 SERVER_IP = "192.168.1.7"                # Your PC's IP (from music server)
 SERVER_PORT = 8888
 
+# Music command queue - zone changes are sent as a single 'switch' (the server
+# crossfades), acks are matched by 'seq' and reconciled on the next loop
+ACK_TIMEOUT = 5  # seconds before an unanswered command is given up on
+
+# Prefetch hints: when the HR trend heads for another zone the server is asked
+# to decode that zone's track ahead of time. 'prefetch' is low priority - it is
+# only sent while no music command is queued or in flight - and its 'keep' list
+# names the tracks the server should hold in its decoded-track cache, so the
+# later 'switch' starts without a cold MP3 decode
+PREFETCH = True
+ZONE_BOUNDARIES = (100, 120)  # determine_hr_zone() thresholds, BPM
+PREFETCH_MARGIN_BPM = 5       # "near a boundary" band
+PREFETCH_DWELL_MS = 5000      # time spent in the band before hinting the other side
+PREFETCH_HORIZON_S = 15       # how far ahead the HR slope is extrapolated
+PREFETCH_SLOPE_S = 10         # the slope is a least-squares fit over this much history
+PREFETCH_PERSIST_MS = 3000    # a slope prediction must hold this long before hinting
+PREFETCH_HISTORY = 32         # readings kept for the fit
+
 # Enable more detailed debugging
 DEBUG = True
 
+# Loop logging: records are buffered and flushed LOG_CHUNK at a time after
+# the sensing path; LOG_STRUCTURED sends them to the server instead of USB
+LOG_CAPACITY = 32
+LOG_CHUNK = 8
+LOG_STRUCTURED = False
+
+log = Logger(level=LOG_DEBUG if DEBUG else LOG_INFO, capacity=LOG_CAPACITY, chunk=LOG_CHUNK)
+log.rate_limit('finger', 5000)
+log.rate_limit('music', 10000)
+log.rate_limit('temp', 10000)
+log.rate_limit('fifo', 5000)
+log.rate_limit('quality', 5000)
+log.rate_limit('hrv', 10000)
+
+# Raw red/IR capture to flash (read back on the PC with tools/ppg_reader.py)
+RECORD_RAW = False
+CAPTURE_FILE = "capture.ppg"
+
+# Steady-state allocation check: after warm-up the sensing/DSP/decision path
+# must not grow gc.mem_alloc(); growth is reported every ALLOC_REPORT_LOOPS.
+# gc.mem_alloc() is heap-wide: with THREADED the control loop holds
+# Acquisition.heap_lock whenever it is awake, and the acquisition thread
+# only measures a step when it can take the lock without waiting. A zone
+# decision only counts if no acquisition step overlapped it.
+ALLOC_CHECK = True
+ALLOC_WARMUP_LOOPS = 20
+ALLOC_REPORT_LOOPS = 100
+
+# Batches whose signal-quality index (0-100) is below this skip HR/SpO2,
+# temperature and music decisions
+QUALITY_THRESHOLD = 50
+
+# Heart-rate variability (RMSSD/SDNN/pNN50) over the last HRV_WINDOW_BEATS
+# beats. With HRV_ZONES a suppressed RMSSD at a resting HR counts as stress
+HRV_WINDOW_BEATS = 32
+HRV_ZONES = False
+STRESS_RMSSD_MS = 20
+
+# Acquisition runs on its own thread (the WiFi stack lives on the other core)
+# and hands one fixed-size result record per FIFO drain to the control loop,
+# so blocking socket I/O or a WiFi reconnect never stalls sampling
+THREADED = True
+ACQ_DRAIN_SAMPLES = 16     # drain when about this many samples are queued: finger
+                           # and SpO2 need >= 10, the 32-deep FIFO keeps the rest as slack
+ACQ_STACK_SIZE = 8192
+CONTROL_INTERVAL_MS = 200  # control loop period (threaded); unthreaded it runs at the drain period
+RESULT_RING_SIZE = 16      # power of two
+
+# Result record layout (one array('i') slot per field)
+R_TICKS = 0        # time.ticks_ms() of the drain
+R_SAMPLES = 1      # samples drained
+R_FLAGS = 2
+R_HR = 3           # BPM, 0 when not calculated
+R_SPO2 = 4         # tenths of a percent
+R_TEMP = 5         # 1/16 degC
+R_QUALITY = 6
+R_PERFUSION = 7    # per mille
+R_CLIPPED = 8
+R_MOTION = 9       # percent
+R_LOST = 10        # samples lost to FIFO overflow
+R_PERIOD = 11      # measured us per sample
+R_RMSSD = 12       # ms, 0 until enough beats
+R_SDNN = 13        # ms
+R_PNN50 = 14       # percent
+RECORD_FIELDS = 15
+FLAG_FINGER = 1
+FLAG_LOW_QUALITY = 2
+
 print(f"🔧 WiFi SSID: {WIFI_SSID}")
 print(f"🔧 Server: {SERVER_IP}:{SERVER_PORT}")
 
@@ -42,6 +152,23 @@ MUSIC_PATHS = {
     'exercise': r"C:\Users\jaysa\OneDrive\Desktop\server\exercise.mp3"
 }
 
+# Built once at import instead of on every call
+ZONE_INFO = {
+    'calm': ('😌', 'Normal/Relaxed state'),
+    'anxiety': ('😰', 'Stress/Anxiety detected'),
+    'exercise': ('💪', 'Exercise/High activity')
+}
+UNKNOWN_ZONE_INFO = ('❓', 'Unknown state')
+
+WIFI_STATUS_MSGS = {
+    network.STAT_IDLE: "Idle",
+    network.STAT_CONNECTING: "Connecting...",
+    network.STAT_WRONG_PASSWORD: "Wrong password!",
+    network.STAT_NO_AP_FOUND: "Network not found!",
+    network.STAT_CONNECT_FAIL: "Connection failed!",
+    network.STAT_GOT_IP: "Got IP address"
+}
+
 class WiFiManager:
     def __init__(self):
         self.wlan = network.WLAN(network.STA_IF)
@@ -99,15 +226,9 @@ class WiFiManager:
         timeout = 30  # Increased timeout
         while not self.wlan.isconnected() and timeout > 0:
             status = self.wlan.status()
-            status_msgs = {
-                network.STAT_IDLE: "Idle",
-                network.STAT_CONNECTING: "Connecting...",
-                network.STAT_WRONG_PASSWORD: "Wrong password!",
-                network.STAT_NO_AP_FOUND: "Network not found!",
-                network.STAT_CONNECT_FAIL: "Connection failed!",
-                network.STAT_GOT_IP: "Got IP address"
-            }
-            status_msg = status_msgs.get(status, f"Unknown status: {status}")
+            status_msg = WIFI_STATUS_MSGS.get(status)
+            if status_msg is None:
+                status_msg = f"Unknown status: {status}"
             print(f"⏳ {status_msg} ({timeout}s remaining)")
             
             if status in [network.STAT_WRONG_PASSWORD, network.STAT_NO_AP_FOUND, network.STAT_CONNECT_FAIL]:
@@ -170,6 +291,12 @@ class WiFiMusicController:
         self.is_playing = False
         self.socket = None
         self.server_connected = False
+        self.seq = 0
+        self.pending = {}      # queue key -> message, newer replaces older
+        self.in_flight = []    # (seq, command, zone, sent_time) awaiting ack
+        self.rx_buffer = b''
+        self.prefetch_supported = PREFETCH
+        self.prefetched = None  # latest hinted zone; 'keep' is it plus the current zone
         
     def test_server_reachability(self):
         """Test if server is reachable"""
@@ -215,6 +342,11 @@ class WiFiMusicController:
             response = self.socket.recv(1024).decode('utf-8').strip()
             if response:
                 print("✅ Server communication test successful")
+                # Acks for commands sent on the old socket will never arrive
+                self.in_flight = []
+                self.rx_buffer = b''
+                # A restarted server has an empty track cache
+                self.prefetched = None
                 return True
             else:
                 print("❌ No response from server")
@@ -230,84 +362,215 @@ class WiFiMusicController:
             self.server_connected = False
             return False
     
-    def send_command(self, command, music_path=None, heart_rate=0, zone='unknown'):
-        # Try to reconnect if not connected
-        if not self.server_connected:
-            print(f"📡 Reconnecting to server for command: {command}")
-            if not self.connect_to_server():
-                return False
-        
-        try:
-            data = {
-                'command': command,
-                'music_path': music_path,
-                'heart_rate': heart_rate,
-                'zone': zone
-            }
-            message = json.dumps(data) + '\n'
-            
-            print(f"📤 Sending: {command} (HR: {heart_rate}, Zone: {zone})")
-            self.socket.send(message.encode('utf-8'))
-            
-            # Wait for response
-            self.socket.settimeout(5.0)
-            response = self.socket.recv(1024).decode('utf-8').strip()
-            
-            if response:
-                response_data = json.loads(response)
-                success = response_data.get('status') == 'OK'
-                message_text = response_data.get('message', '')
-                
-                if success:
-                    print(f"✅ Server response: {message_text}")
-                else:
-                    print(f"❌ Server error: {message_text}")
-                return success
-            
-            print("❌ No response from server")
-            return False
-            
-        except Exception as e:
-            print(f"❌ Send command error: {e}")
-            self.server_connected = False
-            if self.socket:
-                try:
-                    self.socket.close()
-                except:
-                    pass
-                self.socket = None
-            return False
-    
-    def determine_hr_zone(self, heart_rate):
+    def determine_hr_zone(self, heart_rate, rmssd=0):
+        """Zone for a BPM; a known RMSSD (ms) can flag stress at a resting HR"""
         if heart_rate < 60:
             return 'calm'
         elif 60 <= heart_rate <= 100:
+            if rmssd and rmssd < STRESS_RMSSD_MS:
+                return 'anxiety'
             return 'calm'
         elif heart_rate > 100:
             return 'exercise' if heart_rate > 120 else 'anxiety'
         return 'calm'
     
+    def queue_command(self, command, music_path=None, heart_rate=0, zone='unknown', key='music'):
+        """Queue a command for pump(); replaces any unsent command with the same key"""
+        self.seq += 1
+        self.pending[key] = {
+            'command': command,
+            'music_path': music_path,
+            'heart_rate': heart_rate,
+            'zone': zone,
+            'seq': self.seq
+        }
+    
+    def pump(self):
+        """Send queued commands and reconcile any acks without blocking"""
+        if self.in_flight:
+            self._poll_acks()
+        if not self.pending:
+            return
+        
+        if not self.server_connected:
+            log.info('net', "📡 Reconnecting to server for queued commands")
+            if not self.connect_to_server():
+                return
+        
+        # One music command in flight at a time; later zone decisions keep
+        # overwriting the queued one until the server has answered
+        music_busy = any(entry[1] in ('switch', 'play') for entry in self.in_flight)
+        for key in list(self.pending):
+            data = self.pending[key]
+            if key == 'music' and music_busy:
+                continue
+            # Prefetch hints never compete with a real zone change
+            if key == 'prefetch' and (music_busy or 'music' in self.pending):
+                continue
+            try:
+                self.socket.settimeout(1.0)
+                self.socket.send((json.dumps(data) + '\n').encode('utf-8'))
+            except Exception as e:
+                log.error('net', "❌ Send command error: {}", e)
+                self._drop_connection()
+                return
+            del self.pending[key]
+            self.in_flight.append((data['seq'], data['command'], data['zone'], time.time()))
+            if log.enabled(LOG_DEBUG):
+                log.debug('net', "📤 Sent: {} (HR: {}, Zone: {})", data['command'], data['heart_rate'], data['zone'])
+    
+    def send_log_records(self, records):
+        """Structured log sink: ship flushed records as one compact line"""
+        if not self.server_connected:
+            return False
+        self.seq += 1
+        data = {'command': 'log', 'records': records, 'seq': self.seq}
+        try:
+            self.socket.settimeout(1.0)
+            self.socket.send((json.dumps(data) + '\n').encode('utf-8'))
+        except Exception:
+            self._drop_connection()
+            return False
+        self.in_flight.append((self.seq, 'log', None, time.time()))
+        return True
+    
+    def _poll_acks(self):
+        try:
+            self.socket.settimeout(0)
+            chunk = self.socket.recv(1024)
+        except OSError as e:
+            if e.args[0] not in (errno.EAGAIN, errno.ETIMEDOUT):
+                log.error('net', "❌ Receive error: {}", e)
+                self._drop_connection()
+                return
+            chunk = None  # Nothing waiting
+        except Exception as e:
+            log.error('net', "❌ Receive error: {}", e)
+            self._drop_connection()
+            return
+        
+        if chunk == b'':
+            log.error('net', "❌ Server closed connection")
+            self._drop_connection()
+            return
+        
+        if chunk:
+            self.rx_buffer += chunk
+            while b'\n' in self.rx_buffer:
+                line, self.rx_buffer = self.rx_buffer.split(b'\n', 1)
+                if line.strip():
+                    self._reconcile(line)
+        
+        # Give up on commands the server never answered
+        now = time.time()
+        while self.in_flight and now - self.in_flight[0][3] > ACK_TIMEOUT:
+            seq, command, zone, _ = self.in_flight.pop(0)
+            log.warn('net', "⚠️  No ack for {} #{}", command, seq)
+            self._give_up(command, zone)
+    
+    def _give_up(self, command, zone):
+        """Roll back the optimistic state of a command that will never be acked"""
+        if command in ('switch', 'play'):
+            self._reset_music_state(zone)
+        elif command == 'prefetch':
+            self._forget_prefetch(zone)
+    
+    def _reconcile(self, line):
+        """Match one server reply to its in-flight command"""
+        try:
+            response_data = json.loads(line.decode('utf-8'))
+        except ValueError:
+            log.warn('net', "⚠️  Unparseable server reply: {}", line)
+            return
+        if not self.in_flight:
+            return
+        
+        # Replies carry the command's seq; older servers answer in order
+        seq = response_data.get('seq')
+        index = 0 if seq is None else -1
+        for i, entry in enumerate(self.in_flight):
+            if entry[0] == seq:
+                index = i
+                break
+        if index < 0:
+            # Late ack for a command already given up on
+            log.warn('net', "⚠️  Ignoring reply for unknown command #{}", seq)
+            return
+        _, command, zone, _ = self.in_flight.pop(index)
+        
+        message_text = response_data.get('message', '')
+        if response_data.get('status') == 'OK':
+            if command != 'log':
+                log.debug('net', "✅ Server response: {}", message_text)
+        elif command == 'log':
+            # Server doesn't take log records; go back to the console
+            log.sink = None
+            log.warn('net', "⚠️  Structured logging rejected: {}", message_text)
+        elif command == 'prefetch':
+            # Older servers don't know the command; stop sending hints
+            self._forget_prefetch(zone)
+            if 'unknown' in message_text.lower():
+                self.prefetch_supported = False
+            log.warn('net', "⚠️  Prefetch of {} rejected: {}", zone, message_text)
+        else:
+            log.error('net', "❌ Server error for {}: {}", command, message_text)
+            if command in ('switch', 'play'):
+                self._reset_music_state(zone)
+    
+    def _reset_music_state(self, zone):
+        """Forget an optimistic zone change so the main loop retries it"""
+        if self.current_zone == zone and 'music' not in self.pending:
+            self.is_playing = False
+            self.current_zone = None
+            self.prefetched = None
+    
+    def _forget_prefetch(self, zone):
+        if self.prefetched == zone:
+            self.prefetched = None
+    
+    def _drop_connection(self):
+        """Close the socket; pump() reconnects, in-flight acks are lost"""
+        self.server_connected = False
+        if self.socket:
+            try:
+                self.socket.close()
+            except:
+                pass
+            self.socket = None
+        in_flight, self.in_flight = self.in_flight, []
+        for _, command, zone, _ in in_flight:
+            self._give_up(command, zone)
+    
     def play_music_for_zone(self, zone, heart_rate):
         if zone not in MUSIC_PATHS:
-            print(f"Unknown zone: {zone}")
+            log.warn('music', "Unknown zone: {}", zone)
             return False
         
-        music_path = MUSIC_PATHS[zone]
-        if self.is_playing:
-            print("🔇 Stopping current music...")
-            self.send_command('stop')
-            time.sleep(0.5)
-        
-        success = self.send_command('play', music_path, heart_rate, zone)
-        if success:
-            self.current_zone = zone
-            self.music_start_time = time.time()
-            self.is_playing = True
-            print(f"🎵 Playing {zone} music for HR: {heart_rate}")
-            return True
-        else:
-            print(f"❌ Failed to start {zone} music")
+        # Optimistic: state changes now, a failed ack rolls it back later
+        command = 'switch' if self.is_playing else 'play'
+        self.queue_command(command, MUSIC_PATHS[zone], heart_rate, zone)
+        self.current_zone = zone
+        self.prefetched = None  # A hint made for the old zone is stale now
+        self.music_start_time = time.time()
+        self.is_playing = True
+        log.info('switch', "🎵 Queued {} to {} music for HR: {}", command, zone, heart_rate)
+        return True
+    
+    def prefetch_zone(self, zone, heart_rate):
+        """Queue a low-priority hint so the server decodes zone's track before it is needed"""
+        if (not self.prefetch_supported or zone not in MUSIC_PATHS or
+                zone == self.current_zone or zone == self.prefetched):
             return False
+        self.prefetched = zone
+        self.queue_command('prefetch', MUSIC_PATHS[zone], heart_rate, zone, key='prefetch')
+        # Cache contents the server should keep: what's playing plus this hint,
+        # so an earlier hint that never played can be evicted
+        keep = [MUSIC_PATHS[zone]]
+        if self.current_zone in MUSIC_PATHS:
+            keep.append(MUSIC_PATHS[self.current_zone])
+        self.pending['prefetch']['keep'] = keep
+        log.debug('prefetch', "🗄️  Prefetching {} music (HR: {})", zone, heart_rate)
+        return True
     
     def should_change_music(self, new_zone, min_play_time=30):
         if not self.is_playing:
@@ -315,151 +578,306 @@ class WiFiMusicController:
         play_duration = time.time() - self.music_start_time
         return new_zone != self.current_zone and play_duration >= min_play_time
     
-    def stop_music(self):
+    def stop_music(self, timeout_ms=(ACK_TIMEOUT + 1) * 1000):
+        """Queue a stop in place of any unsent zone change and pump until it is acked"""
         if self.is_playing:
-            self.send_command('stop')
+            self.pending.pop('prefetch', None)
+            self.queue_command('stop')
             self.is_playing = False
             self.current_zone = None
+            self.prefetched = None
+            start = time.ticks_ms()
+            while self.pending or self.in_flight:
+                if time.ticks_diff(time.ticks_ms(), start) > timeout_ms:
+                    log.warn('net', "⚠️  Stop not acknowledged")
+                    break
+                self.pump()
+                time.sleep_ms(20)
 
-# Include the HeartRateCalculator and other utility functions from your original code
-class HeartRateCalculator:
-    def __init__(self, sample_rate=100):
-        self.sample_rate = sample_rate
-        self.buffer_size = 500  # 5 seconds of data
-        self.ir_buffer = []
-        self.last_peak_time = 0
-        self.peak_intervals = []
-        self.max_intervals = 10
-        
-    def add_sample(self, ir_value):
-        """Add new IR sample to buffer"""
-        self.ir_buffer.append(ir_value)
-        if len(self.ir_buffer) > self.buffer_size:
-            self.ir_buffer.pop(0)
-    
-    def apply_bandpass_filter(self, data):
-        """Simple moving average filter to remove noise"""
-        if len(data) < 5:
-            return data
-            
-        filtered = []
-        window = 5
-        for i in range(len(data)):
-            start = max(0, i - window // 2)
-            end = min(len(data), i + window // 2 + 1)
-            filtered.append(sum(data[start:end]) / (end - start))
-        return filtered
-    
-    def find_peaks(self, data, min_distance=50):
-        """Find peaks in the signal with minimum distance constraint"""
-        if len(data) < 100:
-            return []
-            
-        # Apply simple filtering
-        filtered_data = self.apply_bandpass_filter(data)
-        
-        # Calculate dynamic threshold
-        mean_val = sum(filtered_data) / len(filtered_data)
-        std_dev = (sum([(x - mean_val) ** 2 for x in filtered_data]) / len(filtered_data)) ** 0.5
-        threshold = mean_val + 0.5 * std_dev
-        
-        peaks = []
-        last_peak_idx = -min_distance
-        
-        for i in range(1, len(filtered_data) - 1):
-            # Check if current point is a local maximum
-            if (filtered_data[i] > filtered_data[i-1] and 
-                filtered_data[i] > filtered_data[i+1] and 
-                filtered_data[i] > threshold and
-                i - last_peak_idx >= min_distance):
-                
-                peaks.append(i)
-                last_peak_idx = i
-                
-        return peaks
-    
-    def calculate_heart_rate(self):
-        """Calculate heart rate using improved peak detection"""
-        if len(self.ir_buffer) < 200:  # Need at least 2 seconds of data
-            return 0
-            
-        # Find peaks in the IR signal
-        peaks = self.find_peaks(self.ir_buffer[-200:])  # Use last 2 seconds
+def get_zone_emoji_and_message(zone):
+    """Get emoji and message for each zone"""
+    return ZONE_INFO.get(zone, UNKNOWN_ZONE_INFO)
+
+class ZoneTrend:
+    """Predicts the next HR zone from the BPM slope and dwell near zone boundaries"""
+    def __init__(self, zone_of, boundaries=ZONE_BOUNDARIES, margin=PREFETCH_MARGIN_BPM,
+                 dwell_ms=PREFETCH_DWELL_MS, horizon_s=PREFETCH_HORIZON_S, slope_s=PREFETCH_SLOPE_S,
+                 persist_ms=PREFETCH_PERSIST_MS, history=PREFETCH_HISTORY):
+        self.zone_of = zone_of  # heart_rate -> zone, i.e. determine_hr_zone
+        self.boundaries = boundaries
+        self.margin = margin
+        self.dwell_ms = dwell_ms
+        self.horizon_s = horizon_s
+        self.slope_s = slope_s
+        self.persist_ms = persist_ms
+        # Reading history ring for the slope fit (integer, allocation-free)
+        self.times = array('i', [0] * history)
+        self.rates = array('i', [0] * history)
+        self.reset()
         
-        if len(peaks) < 2:
+    def reset(self):
+        self.count = 0       # readings in the history ring
+        self.head = 0        # next slot to write
+        self.last_ticks = 0
+        self.candidate = None  # zone the slope points into, not yet persistent
+        self.candidate_ms = 0  # ms the slope has kept pointing there
+        self.dwell = 0       # ms spent within margin of self.boundary
+        self.boundary = None
+        
+    def _trend(self, ticks_ms):
+        """BPM change over horizon_s from a least-squares fit of the last slope_s seconds"""
+        times = self.times
+        rates = self.rates
+        size = len(times)
+        window = self.slope_s * 10  # 100 ms units keep the sums in small ints
+        n = st = sh = stt = sth = span = 0
+        i = self.head
+        for _ in range(self.count):
+            i = (i - 1) % size  # newest first
+            age = time.ticks_diff(ticks_ms, times[i]) // 100
+            if age > window:
+                break
+            t = -age
+            h = rates[i]
+            n += 1
+            st += t
+            sh += h
+            stt += t * t
+            sth += t * h
+            span = age
+        self.count = n  # Older readings have left the window
+        
+        # Too little history to tell a trend from jitter
+        if n < 3 or span < window // 2:
             return 0
-            
-        # Calculate intervals between peaks
-        intervals = []
-        for i in range(1, len(peaks)):
-            interval = (peaks[i] - peaks[i-1]) / self.sample_rate  # Convert to seconds
-            # Filter out unrealistic intervals (30-200 BPM range)
-            if 0.3 <= interval <= 2.0:  # 30-200 BPM
-                intervals.append(interval)
-        
-        if not intervals:
+        den = n * stt - st * st
+        if den <= 0:
             return 0
-            
-        # Average the intervals and convert to BPM
-        avg_interval = sum(intervals) / len(intervals)
-        heart_rate = 60 / avg_interval
-        
-        # Additional filtering: maintain running average
-        self.peak_intervals.append(heart_rate)
-        if len(self.peak_intervals) > self.max_intervals:
-            self.peak_intervals.pop(0)
-            
-        # Return smoothed heart rate
-        return int(sum(self.peak_intervals) / len(self.peak_intervals))
+        num = (n * sth - st * sh) * self.horizon_s * 10
+        return num // den if num >= 0 else -(-num // den)
+        
+    def update(self, heart_rate, ticks_ms):
+        """Feed one reading; returns the zone a transition looks likely into, or None"""
+        dt = time.ticks_diff(ticks_ms, self.last_ticks) if self.count else 0
+        self.last_ticks = ticks_ms
+        self.times[self.head] = ticks_ms
+        self.rates[self.head] = heart_rate
+        self.head = (self.head + 1) % len(self.times)
+        if self.count < len(self.times):
+            self.count += 1
+        
+        zone = self.zone_of(heart_rate)
+        
+        # Rising or falling steadily towards another zone, for persist_ms
+        predicted = self.zone_of(heart_rate + self._trend(ticks_ms))
+        if predicted == zone:
+            self.candidate = None
+        elif predicted != self.candidate:
+            self.candidate = predicted
+            self.candidate_ms = 0
+        else:
+            self.candidate_ms += dt
+        if self.candidate is not None and self.candidate_ms >= self.persist_ms:
+            return predicted
+        
+        # Hovering just next to a boundary: either side may be next
+        near = None
+        for boundary in self.boundaries:
+            if abs(heart_rate - boundary) <= self.margin:
+                near = boundary
+                break
+        if near != self.boundary:
+            self.boundary = near
+            self.dwell = 0
+        elif near is not None:
+            self.dwell += dt
+        if near is not None and self.dwell >= self.dwell_ms:
+            other = self.zone_of(near + 1) if heart_rate <= near else self.zone_of(near)
+            if other != zone:
+                return other
+        return None
 
-def check_finger_present(ir_data):
-    """Check if finger is present on sensor"""
-    if not ir_data or len(ir_data) < 10:
-        return False
-    avg_ir = sum(ir_data) / len(ir_data)
-    if avg_ir < 50000:
-        return False
-    mean_val = avg_ir
-    variance = sum([(x - mean_val) ** 2 for x in ir_data]) / len(ir_data)
-    std_dev = variance ** 0.5
-    return std_dev > 1000
+def drain_interval_ms(sample_rate):
+    """FIFO drain period: ACQ_DRAIN_SAMPLES at the FIFO's output rate"""
+    return int(ACQ_DRAIN_SAMPLES * 1000 // sample_rate)
 
-def calculate_spo2(red_data, ir_data):
-    """Improved SpO2 calculation"""
-    if not red_data or not ir_data or len(red_data) < 10:
-        return 0
-        
-    # Calculate AC and DC components for both signals
-    red_ac = max(red_data) - min(red_data)
-    red_dc = sum(red_data) / len(red_data)
-    ir_ac = max(ir_data) - min(ir_data)
-    ir_dc = sum(ir_data) / len(ir_data)
-    
-    # Avoid division by zero
-    if red_dc == 0 or ir_dc == 0 or ir_ac == 0:
-        return 0
-        
-    # Calculate R ratio
-    r_ratio = (red_ac / red_dc) / (ir_ac / ir_dc)
-    
-    # Improved SpO2 calculation (still simplified)
-    if r_ratio < 0.4:
-        spo2 = 100
-    elif r_ratio < 2.0:
-        spo2 = 110 - 25 * r_ratio
-    else:
-        spo2 = 60
+class AllocationMonitor:
+    """Measures gc.mem_alloc() growth across a steady-state path"""
+    def __init__(self, name, warmup_loops=ALLOC_WARMUP_LOOPS):
+        self.name = name
+        self.warmup_loops = warmup_loops
+        self.loops = 0
+        self.allocating_loops = 0
+        self.max_growth = 0
+        self._start = 0
+        
+    def begin(self):
+        self._start = gc.mem_alloc()
         
-    return min(100, max(85, spo2))  # Clamp to realistic range
+    def end(self):
+        growth = gc.mem_alloc() - self._start
+        self.loops += 1
+        # Negative growth means a collection ran in between; nothing to judge
+        if self.loops > self.warmup_loops and growth > 0:
+            self.allocating_loops += 1
+            if growth > self.max_growth:
+                self.max_growth = growth
+    
+    def report(self):
+        measured = max(0, self.loops - self.warmup_loops)
+        if self.allocating_loops:
+            print(f"⚠️  {self.name} allocates: {self.allocating_loops}/{measured} loops, "
+                  f"max {self.max_growth} bytes | Free: {gc.mem_free()} bytes")
+        else:
+            print(f"💾 {self.name} allocation-free ({measured} loops) | Free: {gc.mem_free()} bytes")
 
-def get_zone_emoji_and_message(zone):
-    """Get emoji and message for each zone"""
-    zone_info = {
-        'calm': ('😌', 'Normal/Relaxed state'),
-        'anxiety': ('😰', 'Stress/Anxiety detected'),
-        'exercise': ('💪', 'Exercise/High activity')
-    }
-    return zone_info.get(zone, ('❓', 'Unknown state'))
+class Acquisition:
+    """Sensor drain + DSP; publishes one result record per drain into a RecordRing"""
+    def __init__(self, sensor, ring, capture=None):
+        self.sensor = sensor
+        self.ring = ring
+        self.capture = capture
+        
+        # Preallocated FIFO buffers, reused every drain
+        self.red_buf = array('i', [0] * FIFO_DEPTH)
+        self.ir_buf = array('i', [0] * FIFO_DEPTH)
+        self.ts_buf = array('i', [0] * FIFO_DEPTH)  # per-sample ticks_us
+        
+        # Rate the FIFO actually delivers (ADC rate / sample averaging)
+        self.sample_rate = sensor.effective_sample_rate
+        self.interval_ms = drain_interval_ms(self.sample_rate)
+        self.hrv = HRVTracker(window=HRV_WINDOW_BEATS)
+        self.hr_calculator = FixedPointHeartRateCalculator(sample_rate=self.sample_rate, hrv=self.hrv)
+        self.quality = SignalQuality()
+        self.alloc_monitor = AllocationMonitor("Acquisition")
+        self.heap_lock = None  # held by the control loop while it may allocate
+        self.busy = False      # a step is running on the acquisition thread
+        self.steps = 0         # steps completed by the acquisition thread
+        
+        self.threaded = False
+        self.running = False
+        self.stopped = True
+        self.errors = 0        # written by the acquisition thread only
+        self.last_error = None
+        
+    def step(self, measure=ALLOC_CHECK):
+        """Drain the FIFO, run the DSP and publish the result; returns samples drained"""
+        sensor = self.sensor
+        red_buf = self.red_buf
+        ir_buf = self.ir_buf
+        ts_buf = self.ts_buf
+        quality = self.quality
+        
+        # Sensing/DSP path - allocation-free after warm-up
+        if measure:
+            self.alloc_monitor.begin()
+        n = sensor.read_sensor_into(red_buf, ir_buf, ts_buf, quality)
+        if n == 0:
+            if measure:
+                self.alloc_monitor.end()
+            return 0
+        
+        flags = 0
+        heart_rate = 0
+        spo2_tenths = 0
+        temp_sixteenths = 0
+        self.hr_calculator.add_samples(ir_buf, n, ts_buf)
+        if check_finger_present_buf(ir_buf, n):
+            flags = FLAG_FINGER
+            if quality.score < QUALITY_THRESHOLD:
+                flags |= FLAG_LOW_QUALITY
+            else:
+                heart_rate = self.hr_calculator.calculate_heart_rate()
+                spo2_tenths = calculate_spo2_tenths(red_buf, ir_buf, n)
+                try:
+                    temp_sixteenths = sensor.read_temperature_raw() or 0
+                except:
+                    temp_sixteenths = 0
+        else:
+            self.hrv.reset()  # Next finger, next rhythm
+        
+        offset = self.ring.reserve()
+        if offset >= 0:  # Full ring: the control loop is behind, drop this result
+            record = self.ring.buffer
+            record[offset + R_TICKS] = time.ticks_ms()
+            record[offset + R_SAMPLES] = n
+            record[offset + R_FLAGS] = flags
+            record[offset + R_HR] = heart_rate
+            record[offset + R_SPO2] = spo2_tenths
+            record[offset + R_TEMP] = temp_sixteenths
+            record[offset + R_QUALITY] = quality.score
+            record[offset + R_PERFUSION] = quality.perfusion
+            record[offset + R_CLIPPED] = quality.clipped
+            record[offset + R_MOTION] = quality.motion
+            record[offset + R_LOST] = sensor.last_overflow
+            record[offset + R_PERIOD] = sensor.clock.period_us
+            hrv = self.hrv
+            ready = hrv.ready
+            record[offset + R_RMSSD] = hrv.rmssd if ready else 0
+            record[offset + R_SDNN] = hrv.sdnn if ready else 0
+            record[offset + R_PNN50] = hrv.pnn50 if ready else 0
+            self.ring.commit()
+        if measure:
+            self.alloc_monitor.end()
+        
+        if self.capture:
+            self.capture.write_samples(red_buf, ir_buf, ts_buf, n)
+        return n
+    
+    def run(self):
+        """Acquisition thread body; never logs (the Logger belongs to the control loop)"""
+        self.stopped = False
+        lock = self.heap_lock
+        while self.running:
+            self.busy = True
+            try:
+                if ALLOC_CHECK and lock.acquire(0):
+                    # Control loop asleep: nothing else allocates during this step
+                    try:
+                        self.step(True)
+                    finally:
+                        lock.release()
+                else:
+                    self.step(False)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+                time.sleep(1)
+            self.busy = False
+            self.steps += 1
+            time.sleep_ms(self.interval_ms)
+        self.close()
+        self.stopped = True
+    
+    def start(self):
+        """Start the acquisition thread; False means the caller must call step() itself"""
+        self.running = True
+        if THREADED and _thread:
+            try:
+                self.heap_lock = _thread.allocate_lock()
+                _thread.stack_size(ACQ_STACK_SIZE)
+                _thread.start_new_thread(self.run, ())
+                self.threaded = True
+            except Exception as e:
+                print(f"⚠️  Acquisition thread unavailable: {e}")
+        return self.threaded
+    
+    def stop(self, timeout_ms=2000):
+        """Stop the acquisition thread and close the capture"""
+        self.running = False
+        if not self.threaded:
+            self.close()
+            return True
+        start = time.ticks_ms()
+        while not self.stopped:
+            if time.ticks_diff(time.ticks_ms(), start) > timeout_ms:
+                return False
+            time.sleep_ms(10)
+        return True
+    
+    def close(self):
+        if self.capture:
+            self.capture.close()
 
 def main():
     """Main function to run the heart rate monitoring system"""
@@ -498,8 +916,20 @@ def main():
         print("🔧 Check if max30102_corrected.py is uploaded")
         return
     
-    hr_calculator = HeartRateCalculator()
+    capture = None
+    if RECORD_RAW:
+        try:
+            capture = PPGCaptureWriter.for_sensor(CAPTURE_FILE, sensor, sensor_id=unique_id())
+            print(f"💾 Recording raw samples to {CAPTURE_FILE}")
+        except Exception as e:
+            print(f"⚠️  Raw capture disabled: {e}")
+    
+    ring = RecordRing(RESULT_RING_SIZE, RECORD_FIELDS)
+    acquisition = Acquisition(sensor, ring, capture)
+    print(f"📈 Effective sample rate: {acquisition.sample_rate} Hz")
     music_controller = WiFiMusicController()
+    zone_trend = ZoneTrend(music_controller.determine_hr_zone)
+    decision_monitor = AllocationMonitor("Zone decision")
     
     stable_readings = 0
     last_zone_change = 0
@@ -524,28 +954,60 @@ def main():
         print("   💻 Music server running on PC")
         print("   🌐 Both devices on same WiFi network")
         print("   🔥 Windows firewall allows connections")
+        acquisition.close()
         return
     
+    if LOG_STRUCTURED:
+        log.sink = music_controller.send_log_records
+    
     print("\n✅ All systems ready!")
     print("📱 Place your finger on the MAX30102 sensor...")
     print("🎵 Music will automatically play based on heart rate zones")
     print("=" * 70)
     
     time.sleep(2)  # Warm up time
+    gc.collect()  # Start the loop from a clean heap
+    
+    if acquisition.start():
+        print(f"🧵 Acquisition running on its own thread (drain every {acquisition.interval_ms} ms)")
+    else:
+        print(f"🧵 Acquisition running in the control loop (drain every {acquisition.interval_ms} ms)")
+    loop_interval_ms = CONTROL_INTERVAL_MS if acquisition.threaded else acquisition.interval_ms
+    heap_lock = acquisition.heap_lock
+    held = False
     
-    # Main monitoring loop
+    # Control loop: network, display and music decisions, fed by result records
+    record = array('i', [0] * RECORD_FIELDS)
     loop_count = 0
+    errors_seen = 0
     while True:
         try:
+            if heap_lock and not held:
+                heap_lock.acquire()  # Allocating from here until the sleep
+                held = True
             loop_count += 1
             
-            # Periodic memory cleanup
-            if loop_count % 100 == 0:
-                gc.collect()
-                print(f"💾 Memory cleanup - Free: {gc.mem_free()} bytes")
+            if not acquisition.threaded:
+                acquisition.step()
+            
+            # Steady-state allocation report (replaces periodic gc.collect)
+            if ALLOC_CHECK and loop_count % ALLOC_REPORT_LOOPS == 0:
+                log.flush_all()
+                acquisition.alloc_monitor.report()
+                decision_monitor.report()
+                print(f"📦 Result ring: {ring.dropped} records dropped")
+                print(f"🔌 I2C: {sensor.i2c_reads} reads, {sensor.i2c_writes} writes for "
+                      f"{sensor.samples_read} samples")
+                if sensor.i2c_errors:
+                    print(f"❌ FIFO read errors: {sensor.i2c_errors} (last: {sensor.last_i2c_error})")
+            
+            if acquisition.errors != errors_seen:
+                errors_seen = acquisition.errors
+                log.error('acq', "❌ Acquisition error: {} ({} total)", acquisition.last_error, errors_seen)
             
-            # Check WiFi connection
+            # Check WiFi connection - blocks only this loop, sampling carries on
             if not wifi.is_connected():
+                log.flush_all()
                 print("❌ WiFi disconnected! Reconnecting...")
                 if not wifi.connect_wifi():
                     time.sleep(5)
@@ -553,47 +1015,66 @@ def main():
                 # Reconnect to server after WiFi reconnection
                 music_controller.server_connected = False
             
-            # Read sensor data
-            red_data, ir_data = sensor.read_sensor()
+            # Send queued music commands / collect acks
+            music_controller.pump()
             
-            if red_data and ir_data:
-                # Add samples to calculator
-                for ir_val in ir_data:
-                    hr_calculator.add_sample(ir_val)
+            while ring.pop_into(record):
+                if record[R_LOST]:
+                    log.warn('fifo', "⚠️  FIFO overflow: {} samples lost ({} total, {} us/sample)",
+                             record[R_LOST], acquisition.sensor.samples_lost, record[R_PERIOD])
+                
+                flags = record[R_FLAGS]
                 
                 # Check if finger is present
-                if not check_finger_present(ir_data):
+                if not flags & FLAG_FINGER:
                     if stable_readings > 0:  # Only show message if we had readings before
-                        print("👆 No finger detected. Please place finger on sensor.")
+                        log.info('finger', "👆 No finger detected. Please place finger on sensor.")
                     stable_readings = 0
-                    time.sleep(1)
+                    zone_trend.reset()
                     continue
                 
-                # Calculate heart rate
-                heart_rate = hr_calculator.calculate_heart_rate()
-                
-                # Calculate SpO2
-                spo2 = calculate_spo2(red_data, ir_data)
+                # Motion, clipping or a weak pulse: hold the last state
+                if flags & FLAG_LOW_QUALITY:
+                    log.info('quality', "📉 Signal quality {} (PI {}‰, clipped {}, motion {}%) - hold still",
+                             record[R_QUALITY], record[R_PERFUSION], record[R_CLIPPED], record[R_MOTION])
+                    continue
                 
-                # Get temperature
-                try:
-                    temperature = sensor.read_temperature()
-                except:
-                    temperature = 0.0
+                heart_rate = record[R_HR]
                 
                 # Only process if we have reasonable HR values
-                if 30 <= heart_rate <= 200:  # Realistic HR range
+                if 30 <= heart_rate <= 200:
+                    # Decision path - allocation-free after warm-up
+                    if ALLOC_CHECK:
+                        steps = -1 if acquisition.busy else acquisition.steps
+                        decision_monitor.begin()
+                    rmssd = record[R_RMSSD]
+                    current_zone = music_controller.determine_hr_zone(heart_rate, rmssd if HRV_ZONES else 0)
+                    predicted_zone = zone_trend.update(heart_rate, record[R_TICKS])
+                    if ALLOC_CHECK and steps == acquisition.steps and not acquisition.busy:
+                        decision_monitor.end()
                     stable_readings += 1
-                    
-                    # Determine heart rate zone
-                    current_zone = music_controller.determine_hr_zone(heart_rate)
                     emoji, message = get_zone_emoji_and_message(current_zone)
+                    spo2_tenths = record[R_SPO2]
+                    temp_sixteenths = record[R_TEMP]
+                    
+                    # Warm the server's cache for the zone we seem to be heading into
+                    if predicted_zone and PREFETCH:
+                        music_controller.prefetch_zone(predicted_zone, heart_rate)
                     
                     # Display current status
-                    status = "Stabilizing..." if stable_readings < 10 else "Stable"
-                    print(f"❤️  HR: {heart_rate} BPM | 🩸 SpO2: {spo2:.1f}% | 🌡️  {temperature:.1f}°C")
-                    print(f"{emoji} Zone: {current_zone.upper()} - {message}")
-                    print(f"📊 Status: {status} (Reading #{stable_readings})")
+                    log.info('reading', "❤️  HR: {} BPM | 🩸 SpO2: {}.{}% | 📶 Q{}",
+                             heart_rate, spo2_tenths // 10, spo2_tenths % 10, record[R_QUALITY])
+                    log.info('zone', "{} Zone: {} - {} | 📊 Reading #{}",
+                             emoji, current_zone, message, stable_readings)
+                    if stable_readings == 1:
+                        log.info('status', "📊 Status: Stabilizing...")
+                    elif stable_readings == 10:
+                        log.info('status', "📊 Status: Stable")
+                    if rmssd and log.enabled(LOG_DEBUG):
+                        log.debug('hrv', "💓 HRV: RMSSD {} ms | SDNN {} ms | pNN50 {}%",
+                                  rmssd, record[R_SDNN], record[R_PNN50])
+                    if log.enabled(LOG_DEBUG):
+                        log.debug('temp', "🌡️  {}.{}°C", temp_sixteenths // 16, (temp_sixteenths % 16) * 10 // 16)
                     
                     # Music control logic
                     if stable_readings >= 10:  # Only control music when stable
@@ -605,34 +1086,45 @@ def main():
                             
                             # Prevent too frequent changes
                             if current_time - last_zone_change >= 30:  # 30 seconds minimum
-                                print(f"🎵 Attempting to play {current_zone} music...")
+                                log.info('switch', "🎵 Attempting to play {} music...", current_zone)
                                 if music_controller.play_music_for_zone(current_zone, heart_rate):
                                     last_zone_change = current_time
                         
                         # Show music status
                         if music_controller.is_playing:
                             play_time = int(current_time - music_controller.music_start_time)
-                            print(f"🎵 Currently playing: {music_controller.current_zone} music ({play_time}s)")
+                            log.info('music', "🎵 Currently playing: {} music ({}s)",
+                                     music_controller.current_zone, play_time)
                         
                 else:
                     if stable_readings > 0:  # Only reset if we had stable readings
                         stable_readings = 0
-                        print("📊 Calculating... please keep finger still")
-                
-                print("-" * 70)
-                
-            time.sleep(0.5)  # Sampling interval
+                        log.info('calc', "📊 Calculating... please keep finger still")
+            
+            # Console/telemetry output happens here, off the sampling thread
+            log.flush()
+            if held:
+                heap_lock.release()
+                held = False
+            time.sleep_ms(loop_interval_ms)
             
         except KeyboardInterrupt:
             print("\n🛑 Stopping music and monitoring...")
+            if not acquisition.stop():
+                print("⚠️  Acquisition thread did not stop in time")
+            log.flush_all()
             music_controller.stop_music()
+            log.flush_all()
+            if capture:
+                print(f"💾 Saved {capture.samples_written} samples to {CAPTURE_FILE}")
             break
             
         except Exception as e:
-            print(f"❌ Error in main loop: {e}")
-            print(f"📊 Loop count: {loop_count}")
+            log.error('loop', "❌ Error in main loop: {} (loop {})", e, loop_count)
+            log.flush_all()
             time.sleep(1)
 
+
 if __name__ == "__main__":
     print("=" * 70)
     print("🎵 WIFI HEART RATE MUSIC SYSTEM - ESP32")
@@ -0,0 +1,2 @@
+# Host-side tools for the ESP32 Heart Rate Music System.
+# These run on a PC (CPython + NumPy), not on the ESP32.
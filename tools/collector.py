@@ -0,0 +1,478 @@
+# collector.py - Multi-device reading collector
+# Runs on the PC, not the ESP32. From the project root:
+#
+#   python -m tools.collector --db readings.db --port 8890
+#
+# Storage side for many devices, meant to replace the single flat
+# data/readings.json: any number of clients stream readings over TCP at the
+# same time, each gets a stable device ID (the ESP32's machine.unique_id()
+# in hex) and every connection or explicit restart a new session ID, and
+# everything lands in SQLite. main.py does not send to it yet - today the
+# only client is tools/loadgen.py, which speaks the protocol below.
+#
+# Protocol: newline-delimited JSON, like the music server. A request with a
+# 'seq' gets {'status': 'OK' | 'ERROR', 'seq': ..., ...} back.
+#
+#   {"command": "hello", "device": "<unique_id hex>", "seq": 1}
+#       -> device_id, session_id
+#   {"command": "readings", "records": [[ticks_ms, heart_rate, spo2_tenths, quality, rmssd], ...]}
+#   {"command": "reading", "ticks": ..., "heart_rate": ..., "spo2": ..., "quality": ..., "rmssd": ...}
+#   {"command": "session"}                        -> new session_id (e.g. finger replaced)
+#   {"command": "live", "device_id": 3, "limit": 50}  -> latest readings from memory
+#   {"command": "stats"}
+#
+# Ingestion never touches the disk. Readings go into a bounded per-device ring
+# (for live views) and a pending list; every FLUSH_INTERVAL or BATCH_SIZE rows
+# the pending list is handed to one writer thread as a single transaction.
+# When the disk falls behind, acks carry 'throttle': true once the backlog
+# passes HIGH_WATER rows, and past MAX_BACKLOG the oldest unwritten rows are
+# dropped (and counted) instead of stalling the event loop. If the database
+# can't be opened the collector refuses to start. Reading values
+# must be integers SQLite can store (or null); a request with any other value
+# is rejected whole. A batch the writer fails on counts as dropped.
+
+import argparse
+import asyncio
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+
+DEFAULT_PORT = 8890
+RING_SIZE = 256          # live readings kept per device
+BATCH_SIZE = 2000        # rows per storage transaction
+FLUSH_INTERVAL = 0.5     # seconds, upper bound on storage latency
+MAX_BATCHES_QUEUED = 4   # batches waiting for the writer thread
+HIGH_WATER = 20000       # backlog (rows) at which devices are asked to throttle
+MAX_BACKLOG = 200000     # backlog beyond which the oldest unwritten rows are dropped
+READING_FIELDS = ('ticks', 'heart_rate', 'spo2', 'quality', 'rmssd')
+SQLITE_MAX_INT = 2 ** 63 - 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY,
+    uid TEXT UNIQUE NOT NULL,
+    first_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    device_id INTEGER NOT NULL REFERENCES devices(id),
+    peer TEXT,
+    started REAL NOT NULL,
+    ended REAL
+);
+CREATE TABLE IF NOT EXISTS readings (
+    session_id INTEGER NOT NULL,
+    device_id INTEGER NOT NULL,
+    received REAL NOT NULL,
+    ticks INTEGER,
+    heart_rate INTEGER,
+    spo2 INTEGER,
+    quality INTEGER,
+    rmssd INTEGER
+);
+CREATE INDEX IF NOT EXISTS readings_session ON readings (session_id, received);
+"""
+
+
+def reading_values(values):
+    """
+    Coerce one record to a READING_FIELDS tuple
+
+    Missing trailing fields become None, extra fields are ignored.
+
+    Raises:
+        ValueError: a value is not an integer SQLite can store
+    """
+    if isinstance(values, (str, bytes, dict)):
+        raise ValueError(f"reading must be a list, got {type(values).__name__}")
+    values = tuple(values[:len(READING_FIELDS)])
+    coerced = []
+    for name, value in zip(READING_FIELDS, values):
+        if value is not None:
+            try:
+                value = int(value)
+            except (OverflowError, TypeError, ValueError):
+                raise ValueError(f"{name} is not an integer: {value!r}")
+            if not -SQLITE_MAX_INT - 1 <= value <= SQLITE_MAX_INT:
+                raise ValueError(f"{name} out of range: {value}")
+        coerced.append(value)
+    return tuple(coerced) + (None,) * (len(READING_FIELDS) - len(coerced))
+
+
+class StorageWriter(threading.Thread):
+    """Writes each queued batch in one SQLite transaction, off the event loop"""
+
+    def __init__(self, db_path, max_batches=MAX_BATCHES_QUEUED):
+        super().__init__(name='collector-writer', daemon=True)
+        self.db_path = db_path
+        self.batches = queue.Queue(maxsize=max_batches)
+        self.rows_written = 0
+        self.rows_failed = 0  # readings in batches that could not be written
+        self.transactions = 0
+        self.busy_seconds = 0.0
+        self.error = None
+        self.ready = threading.Event()  # set once the database is open (or failed to open)
+
+    def run(self):
+        try:
+            db = sqlite3.connect(self.db_path)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        except sqlite3.Error as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        try:
+            while True:
+                batch = self.batches.get()
+                if batch is None:
+                    break
+                devices, sessions, ended, readings = batch
+                started = time.perf_counter()
+                try:
+                    self._write(db, devices, sessions, ended, readings)
+                except Exception as e:  # One bad batch must not end the writer
+                    self.error = e
+                    self.rows_failed += len(readings)
+                    print(f"❌ Storage error, {len(readings)} readings lost: {e}")
+                    try:  # Keep the device/session registry consistent
+                        self._write(db, devices, sessions, ended, [])
+                    except Exception:
+                        pass
+                    continue
+                self.busy_seconds += time.perf_counter() - started
+                self.rows_written += len(readings)
+                self.transactions += 1
+        finally:
+            db.close()
+
+    @staticmethod
+    def _write(db, devices, sessions, ended, readings):
+        with db:
+            db.executemany('INSERT OR IGNORE INTO devices (id, uid, first_seen) VALUES (?, ?, ?)', devices)
+            db.executemany('INSERT INTO sessions (id, device_id, peer, started) VALUES (?, ?, ?, ?)', sessions)
+            db.executemany('UPDATE sessions SET ended = ? WHERE id = ?', ended)
+            db.executemany('INSERT INTO readings VALUES (?, ?, ?, ?, ?, ?, ?, ?)', readings)
+
+    def submit(self, batch):
+        """Queue a batch without blocking; False when the writer is saturated"""
+        try:
+            self.batches.put_nowait(batch)
+            return True
+        except queue.Full:
+            return False
+
+    def put(self, batch):
+        """Queue a batch, waiting for room; False if the writer thread is gone"""
+        while self.is_alive():
+            try:
+                self.batches.put(batch, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def stop(self):
+        if self.put(None):
+            self.join()
+
+
+class Device:
+    def __init__(self, device_id, uid, ring_size=RING_SIZE):
+        self.id = device_id
+        self.uid = uid
+        self.live = deque(maxlen=ring_size)  # (received, ticks, hr, spo2, quality, rmssd)
+        self.session_id = None
+        self.connections = 0
+        self.readings = 0
+        self.last_seen = 0.0
+
+
+class Collector:
+    def __init__(self, db_path, ring_size=RING_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 high_water=HIGH_WATER, max_backlog=MAX_BACKLOG):
+        self.db_path = db_path
+        self.ring_size = ring_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.high_water = high_water
+        self.max_backlog = max_backlog
+
+        self.devices = {}      # uid -> Device
+        self.by_id = {}        # device_id -> Device
+        self._next_device_id = 1
+        self._next_session_id = 1
+        self._load_registry()
+
+        # Rows waiting for the next storage batch
+        self._new_devices = []
+        self._new_sessions = []
+        self._ended_sessions = []
+        self._pending = []
+
+        self.received = 0
+        self.dropped = 0
+        self.writer = StorageWriter(db_path)
+        self._flush_task = None
+        self._server = None
+
+    def _load_registry(self):
+        """Create the schema and continue the device/session numbering"""
+        db = sqlite3.connect(self.db_path)
+        try:
+            db.executescript(SCHEMA)
+            for device_id, uid in db.execute('SELECT id, uid FROM devices'):
+                device = Device(device_id, uid, self.ring_size)
+                self.devices[uid] = device
+                self.by_id[device_id] = device
+            self._next_device_id = (db.execute('SELECT MAX(id) FROM devices').fetchone()[0] or 0) + 1
+            self._next_session_id = (db.execute('SELECT MAX(id) FROM sessions').fetchone()[0] or 0) + 1
+            db.commit()
+        finally:
+            db.close()
+
+    @property
+    def backlog(self):
+        """Readings received but not yet written (or lost)"""
+        return self.received - self.dropped - self.writer.rows_failed - self.writer.rows_written
+
+    # -- ingestion (event loop only) --
+
+    def register(self, uid):
+        device = self.devices.get(uid)
+        if device is None:
+            device = Device(self._next_device_id, uid, self.ring_size)
+            self._next_device_id += 1
+            self.devices[uid] = device
+            self.by_id[device.id] = device
+            self._new_devices.append((device.id, uid, time.time()))
+        return device
+
+    def start_session(self, device, peer):
+        self.end_session(device)
+        device.session_id = self._next_session_id
+        self._next_session_id += 1
+        self._new_sessions.append((device.session_id, device.id, peer, time.time()))
+        return device.session_id
+
+    def end_session(self, device):
+        if device.session_id is not None:
+            self._ended_sessions.append((time.time(), device.session_id))
+            device.session_id = None
+
+    def release(self, device):
+        """A connection bound to device went away (or rebound)"""
+        device.connections -= 1
+        if device.connections == 0:
+            self.end_session(device)
+
+    def add_reading(self, device, values, received):
+        """values: a reading_values() tuple"""
+        device.live.append((received,) + values)
+        self._pending.append((device.session_id, device.id, received) + values)
+        device.readings += 1
+        device.last_seen = received
+        self.received += 1
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Hand pending rows to the writer; shed the oldest when far behind"""
+        if not (self._pending or self._new_devices or self._new_sessions or self._ended_sessions):
+            return
+        if not self.writer.is_alive():
+            # Nothing will ever write these; count them instead of queueing forever
+            self.dropped += len(self._pending)
+            self._pending = []
+            return
+        batch = (self._new_devices, self._new_sessions, self._ended_sessions, self._pending)
+        if self.writer.submit(batch):
+            self._new_devices = []
+            self._new_sessions = []
+            self._ended_sessions = []
+            self._pending = []
+            return
+        # Writer saturated: keep accumulating, but never beyond max_backlog
+        excess = len(self._pending) - self.max_backlog
+        if excess > 0:
+            del self._pending[:excess]
+            self.dropped += excess
+
+    @property
+    def throttle(self):
+        return self.backlog >= self.high_water
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    async def handle_connection(self, reader, writer):
+        peer = '{}:{}'.format(*writer.get_extra_info('peername')[:2])
+        device = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    message = json.loads(line)
+                    if not isinstance(message, dict):
+                        raise ValueError("not a JSON object")
+                except ValueError as e:
+                    reply = {'status': 'ERROR', 'message': f"bad request: {e}"}
+                    message = {}
+                else:
+                    # A rejected request still gets its ERROR reply under its seq
+                    try:
+                        reply, device = self.handle_message(message, device, peer)
+                    except (ValueError, KeyError, TypeError) as e:
+                        reply = {'status': 'ERROR', 'message': f"bad request: {e}"}
+                if reply is not None and 'seq' in message:
+                    reply['seq'] = message['seq']
+                    writer.write((json.dumps(reply) + '\n').encode('utf-8'))
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if device is not None:
+                self.release(device)
+            writer.close()
+
+    def handle_message(self, message, device, peer):
+        """Apply one request; returns (reply or None, device bound to the connection)"""
+        command = message['command']
+        now = time.time()
+        if command == 'hello':
+            # A repeated hello on a connection starts a new session, like 'session'
+            uid = str(message['device'])
+            if device is None or device.uid != uid:
+                if device is not None:
+                    self.release(device)
+                device = self.register(uid)
+                device.connections += 1
+            session_id = self.start_session(device, peer)
+            return {'status': 'OK', 'device_id': device.id, 'session_id': session_id}, device
+        if command == 'live':
+            target = self.by_id.get(int(message['device_id']))
+            if target is None:
+                return {'status': 'ERROR', 'message': 'unknown device'}, device
+            limit = int(message.get('limit', self.ring_size))
+            records = list(target.live)[-limit:] if limit > 0 else []
+            return {'status': 'OK', 'device_id': target.id, 'session_id': target.session_id,
+                    'fields': ('received',) + READING_FIELDS, 'records': records}, device
+        if command == 'stats':
+            return {'status': 'OK', **self.stats()}, device
+        if device is None:
+            return {'status': 'ERROR', 'message': 'send hello first'}, device
+
+        if command == 'readings':
+            # Validate the whole request before storing any of it
+            for values in [reading_values(values) for values in message['records']]:
+                self.add_reading(device, values, now)
+        elif command == 'reading':
+            self.add_reading(device, reading_values([message.get(name) for name in READING_FIELDS]), now)
+        elif command == 'session':
+            return {'status': 'OK', 'session_id': self.start_session(device, peer)}, device
+        else:
+            return {'status': 'ERROR', 'message': f"unknown command {command}"}, device
+        return {'status': 'OK', 'throttle': self.throttle}, device
+
+    def stats(self):
+        return {
+            'devices': len(self.devices),
+            'connected': sum(1 for device in self.devices.values() if device.connections),
+            'received': self.received,
+            'written': self.writer.rows_written,
+            'transactions': self.writer.transactions,
+            'backlog': self.backlog,
+            'dropped': self.dropped + self.writer.rows_failed,
+            'storage_error': str(self.writer.error) if self.writer.error else None,
+        }
+
+    # -- lifecycle --
+
+    async def start(self, host='0.0.0.0', port=DEFAULT_PORT):
+        """
+        Start the writer and the server
+
+        Raises:
+            RuntimeError: the database could not be opened
+        """
+        self.writer.start()
+        await asyncio.get_running_loop().run_in_executor(None, self.writer.ready.wait)
+        if self.writer.error is not None:
+            raise RuntimeError(f"storage unavailable: {self.db_path}: {self.writer.error}")
+        self._server = await asyncio.start_server(self.handle_connection, host, port, limit=1 << 20)
+        self._flush_task = asyncio.ensure_future(self._flush_loop())
+        return self._server
+
+    async def stop(self):
+        """Stop accepting, end open sessions and write everything still pending"""
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._flush_task:
+            self._flush_task.cancel()
+        for device in self.devices.values():
+            self.end_session(device)
+        batch = (self._new_devices, self._new_sessions, self._ended_sessions, self._pending)
+        self._new_devices, self._new_sessions, self._ended_sessions, self._pending = [], [], [], []
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, self.writer.put, batch):
+            self.dropped += len(batch[3])
+            print(f"❌ Storage writer stopped ({self.writer.error}), {len(batch[3])} readings not written")
+        await loop.run_in_executor(None, self.writer.stop)
+
+
+async def _serve(args):
+    collector = Collector(args.db, ring_size=args.ring_size, batch_size=args.batch_size,
+                          flush_interval=args.flush_interval)
+    await collector.start(args.host, args.port)
+    print(f"📡 Collector listening on {args.host}:{args.port}, storing to {args.db}")
+    try:
+        last = collector.stats()
+        while True:
+            await asyncio.sleep(args.report)
+            if not collector.writer.is_alive():
+                print(f"❌ Storage writer stopped ({collector.writer.error}), shutting down")
+                break
+            stats = collector.stats()
+            rate = (stats['received'] - last['received']) / args.report
+            print(f"📊 {stats['connected']}/{stats['devices']} devices | {rate:.0f} readings/s | "
+                  f"written {stats['written']} in {stats['transactions']} tx | "
+                  f"backlog {stats['backlog']} | dropped {stats['dropped']}")
+            last = stats
+    finally:
+        await collector.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Collect readings from many ESP32 devices into SQLite")
+    parser.add_argument('--db', default='readings.db', help="SQLite database file")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--ring-size', type=int, default=RING_SIZE, help="live readings kept per device")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="rows per storage transaction")
+    parser.add_argument('--flush-interval', type=float, default=FLUSH_INTERVAL,
+                        help="seconds between storage batches")
+    parser.add_argument('--report', type=float, default=10, help="seconds between status lines")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        print("\n🛑 Collector stopped")
+    except RuntimeError as e:
+        print(f"❌ Collector not started: {e}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,185 @@
+# loadgen.py - Load generator for tools/collector.py
+# Runs on the PC. From the project root:
+#
+#   python -m tools.loadgen --local --devices 50 --rate 100 --seconds 20
+#   python -m tools.loadgen --host 192.168.1.7 --devices 20 --rate 50
+#
+# Opens one connection per simulated device, says hello, then streams
+# 'readings' batches at a fixed per-device rate on an absolute schedule (a
+# slow ack doesn't slow the sender down). Afterwards it waits for the
+# collector to write everything and checks that the sustained rate and the
+# stored row count hold up. --local runs a collector in-process on a
+# temporary database.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from tools.collector import DEFAULT_PORT, Collector
+
+DRAIN_TIMEOUT = 30  # seconds to wait for the collector to write everything
+
+
+class SimulatedDevice:
+    def __init__(self, index, rate, batch):
+        self.uid = f"loadgen{index:04d}"
+        self.rate = rate
+        self.batch = batch
+        self.sent = 0
+        self.acked = 0
+        self.throttled = 0
+        self.errors = 0
+        self.latencies = []
+        self._sent_at = {}
+        self._heart_rate = random.randint(60, 110)
+
+    def _records(self, ticks_ms):
+        records = []
+        for i in range(self.batch):
+            self._heart_rate = min(180, max(45, self._heart_rate + random.randint(-1, 1)))
+            records.append([ticks_ms + i * 1000 // self.rate, self._heart_rate,
+                            random.randint(950, 990), random.randint(50, 100), random.randint(15, 60)])
+        return records
+
+    async def _read_acks(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            reply = json.loads(line)
+            sent_at = self._sent_at.pop(reply.get('seq'), None)
+            if sent_at is not None:
+                self.latencies.append(time.perf_counter() - sent_at)
+            if reply.get('status') != 'OK':
+                self.errors += 1
+            elif reply.get('throttle'):
+                self.throttled += 1
+            self.acked += 1
+
+    async def run(self, host, port, seconds):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write((json.dumps({'command': 'hello', 'device': self.uid, 'seq': 0}) + '\n').encode('utf-8'))
+        await writer.drain()
+        hello = json.loads(await reader.readline())
+        if hello.get('status') != 'OK':
+            raise RuntimeError(f"{self.uid}: hello rejected: {hello}")
+        acks = asyncio.ensure_future(self._read_acks(reader))
+
+        interval = self.batch / self.rate
+        start = time.perf_counter()
+        seq = 0
+        # Spread devices over one interval so they don't all send at once
+        await asyncio.sleep(random.random() * interval)
+        while time.perf_counter() - start < seconds:
+            seq += 1
+            ticks_ms = int((time.perf_counter() - start) * 1000)
+            message = {'command': 'readings', 'seq': seq, 'records': self._records(ticks_ms)}
+            self._sent_at[seq] = time.perf_counter()
+            writer.write((json.dumps(message) + '\n').encode('utf-8'))
+            await writer.drain()
+            self.sent += self.batch
+            delay = start + seq * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        # Give outstanding acks a moment, then hang up (ends the session)
+        deadline = time.perf_counter() + 5
+        while self._sent_at and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        acks.cancel()
+        writer.close()
+        return hello['device_id'], hello['session_id']
+
+
+async def _request(host, port, message):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write((json.dumps({**message, 'seq': 1}) + '\n').encode('utf-8'))
+    await writer.drain()
+    reply = json.loads(await reader.readline())
+    writer.close()
+    return reply
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def _run(args):
+    collector = None
+    host, port = args.host, args.port
+    if args.local:
+        db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='loadgen'), 'readings.db')
+        collector = Collector(db_path)
+        server = await collector.start('127.0.0.1', 0)
+        host, port = '127.0.0.1', server.sockets[0].getsockname()[1]
+        print(f"📡 Local collector on port {port}, storing to {db_path}")
+
+    before = await _request(host, port, {'command': 'stats'})
+    devices = [SimulatedDevice(i, args.rate, args.batch) for i in range(args.devices)]
+    target = args.devices * args.rate
+    print(f"🔄 {args.devices} devices x {args.rate} readings/s = {target} readings/s for {args.seconds}s...")
+
+    started = time.perf_counter()
+    sessions = await asyncio.gather(*(device.run(host, port, args.seconds) for device in devices))
+    elapsed = time.perf_counter() - started
+    sent = sum(device.sent for device in devices)
+
+    # Wait for the collector to catch up with storage
+    expected = before['written'] + sent
+    deadline = time.perf_counter() + DRAIN_TIMEOUT
+    while True:
+        stats = await _request(host, port, {'command': 'stats'})
+        if stats['written'] + stats['dropped'] - before['dropped'] >= expected or time.perf_counter() > deadline:
+            break
+        await asyncio.sleep(0.2)
+    drained = time.perf_counter() - started
+
+    if collector:
+        await collector.stop()
+
+    latencies = [latency for device in devices for latency in device.latencies]
+    rate = sent / elapsed
+    written = stats['written'] - before['written']
+    dropped = stats['dropped'] - before['dropped']
+    print(f"📊 Sent {sent} readings in {elapsed:.1f}s = {rate:.0f} readings/s "
+          f"({len(set(session for _, session in sessions))} sessions)")
+    print(f"⏱️  Ack latency p50 {_percentile(latencies, 0.5) * 1000:.1f} ms, "
+          f"p99 {_percentile(latencies, 0.99) * 1000:.1f} ms | throttled {sum(d.throttled for d in devices)} | "
+          f"errors {sum(d.errors for d in devices)}")
+    print(f"💾 Written {written} rows in {stats['transactions'] - before['transactions']} transactions "
+          f"({drained:.1f}s incl. drain) | dropped {dropped}")
+
+    min_rate = args.min_rate if args.min_rate is not None else 0.95 * target
+    ok = rate >= min_rate and written == sent and not any(device.errors for device in devices)
+    if ok:
+        print(f"✅ Sustained {rate:.0f} readings/s (≥ {min_rate:.0f}), all readings stored")
+    else:
+        print(f"❌ Below target: {rate:.0f} readings/s (need {min_rate:.0f}), stored {written}/{sent}")
+    return 0 if ok else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the multi-device collector")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--local', action='store_true', help="run a collector in-process")
+    parser.add_argument('--db', default=None, help="database for --local (default: temporary)")
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--rate', type=int, default=100, help="readings per second per device")
+    parser.add_argument('--batch', type=int, default=10, help="readings per message")
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--min-rate', type=float, default=None,
+                        help="readings/s required to pass (default: 95%% of devices x rate)")
+    args = parser.parse_args(argv)
+    return asyncio.run(_run(args))
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
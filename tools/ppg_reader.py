@@ -0,0 +1,173 @@
+# ppg_reader.py - Memory-mapped reader for .ppg raw captures
+# Runs on the PC. The file format is documented in lib/ppg_capture.py.
+#
+#   python -m tools.ppg_reader capture.ppg            # print header and stats
+#   python -m tools.ppg_reader capture.ppg --csv out.csv
+#
+# Opening a capture only walks the chunk headers; sample payloads are decoded
+# into NumPy arrays chunk by chunk when asked for, so multi-hour recordings
+# never have to fit in RAM.
+
+import argparse
+import mmap
+import struct
+
+import numpy as np
+
+from lib.ppg_capture import (CHUNK_HEADER_FORMAT, CHUNK_HEADER_SIZE, CHUNK_MAGIC, HEADER_FORMAT,
+                             HEADER_SIZE, MAGIC, VERSION, nominal_period_us)
+
+
+def decode_varints(payload):
+    """Decode a uint8 array of zigzag varints into an int64 array"""
+    if len(payload) == 0:
+        return np.zeros(0, dtype=np.int64)
+    last_byte = (payload & 0x80) == 0
+    ends = np.flatnonzero(last_byte)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    owner = np.repeat(np.arange(len(starts)), ends - starts + 1)
+    shift = 7 * (np.arange(ends[-1] + 1) - starts[owner])
+    values = np.add.reduceat((payload[:ends[-1] + 1] & 0x7F).astype(np.int64) << shift, starts)
+    return (values >> 1) ^ -(values & 1)
+
+
+class PPGCapture:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mm) < HEADER_SIZE:
+            raise ValueError(f"{path}: too short for a PPG capture header")
+        (magic, version, led_mode, sample_avg, _, sample_rate_mhz, pulse_width, adc_range,
+         red_current, ir_current, part_id, revision_id, sensor_id,
+         start_time) = struct.unpack_from(HEADER_FORMAT, self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path}: not a PPG capture file")
+        if version != VERSION:
+            raise ValueError(f"{path}: unsupported capture version {version}")
+
+        self.header = {
+            'led_mode': led_mode,
+            'sample_rate': sample_rate_mhz / 1000,
+            'sample_avg': sample_avg,
+            'effective_rate': sample_rate_mhz / 1000 / sample_avg,
+            'pulse_width': pulse_width,
+            'adc_range': adc_range,
+            'red_current': red_current,
+            'ir_current': ir_current,
+            'part_id': part_id,
+            'revision_id': revision_id,
+            'sensor_id': sensor_id.rstrip(b'\x00').hex(),
+            'start_time': start_time,
+        }
+        self.period_us = nominal_period_us(self.header['sample_rate'], sample_avg)
+        self._index = self._build_index()
+        self.truncated = self._index_end < len(self._mm)
+
+    def _build_index(self):
+        """Walk chunk headers once: (payload offset, payload length, count, t0, red0, ir0)"""
+        index = []
+        offset = HEADER_SIZE
+        size = len(self._mm)
+        while offset + CHUNK_HEADER_SIZE <= size:
+            magic, count, payload_len, t0, red0, ir0 = struct.unpack_from(CHUNK_HEADER_FORMAT, self._mm, offset)
+            payload_offset = offset + CHUNK_HEADER_SIZE
+            if magic != CHUNK_MAGIC or payload_offset + payload_len > size:
+                break  # Partially written tail (device reset mid-chunk)
+            index.append((payload_offset, payload_len, count, t0, red0, ir0))
+            offset = payload_offset + payload_len
+        self._index_end = offset
+        self._chunk_starts = np.cumsum([0] + [entry[2] for entry in index])
+        return index
+
+    def __len__(self):
+        return int(self._chunk_starts[-1])
+
+    @property
+    def num_chunks(self):
+        return len(self._index)
+
+    @property
+    def duration(self):
+        """Seconds between the first and last sample"""
+        if not self._index:
+            return 0.0
+        return float(self.chunk(self.num_chunks - 1)[0][-1]) / 1e6
+
+    def chunk(self, i):
+        """Decode chunk i into (t_us, red, ir) int64 arrays"""
+        payload_offset, payload_len, count, t0, red0, ir0 = self._index[i]
+        payload = np.frombuffer(self._mm, dtype=np.uint8, count=payload_len, offset=payload_offset)
+        deltas = decode_varints(payload)
+        if len(deltas) != 3 * (count - 1):
+            raise ValueError(f"{self.path}: corrupt chunk {i}")
+        deltas = deltas.reshape(-1, 3)
+
+        intervals = np.cumsum(np.concatenate(([self.period_us], deltas[:, 0])))[1:]
+        t_us = t0 + np.concatenate(([0], np.cumsum(intervals)))
+        red = red0 + np.concatenate(([0], np.cumsum(deltas[:, 1])))
+        ir = ir0 + np.concatenate(([0], np.cumsum(deltas[:, 2])))
+        return t_us, red, ir
+
+    def chunks(self):
+        """Iterate decoded chunks in order"""
+        for i in range(self.num_chunks):
+            yield self.chunk(i)
+
+    def read(self, start=0, stop=None):
+        """Decode samples [start, stop) touching only the chunks that cover them"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        first = int(np.searchsorted(self._chunk_starts, start, side='right')) - 1
+        last = int(np.searchsorted(self._chunk_starts, stop, side='left'))
+        parts = [self.chunk(i) for i in range(first, last)]
+        base = int(self._chunk_starts[first])
+        t_us, red, ir = (np.concatenate([p[k] for p in parts]) for k in range(3))
+        return t_us[start - base:stop - base], red[start - base:stop - base], ir[start - base:stop - base]
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_capture(path):
+    """(red, ir, effective sample rate) for tools.reprocess"""
+    with PPGCapture(path) as capture:
+        _, red, ir = capture.read()
+        return red, ir, capture.header['effective_rate']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or export a .ppg raw capture")
+    parser.add_argument('path')
+    parser.add_argument('--csv', help="export t_us,red,ir to a CSV file, one chunk at a time")
+    args = parser.parse_args(argv)
+
+    with PPGCapture(args.path) as capture:
+        print(f"📁 {args.path}")
+        for key, value in capture.header.items():
+            print(f"   {key}: {value}")
+        print(f"📊 {len(capture)} samples in {capture.num_chunks} chunks, {capture.duration:.1f}s")
+        if capture.truncated:
+            print("⚠️  Trailing partial chunk ignored")
+
+        if args.csv:
+            with open(args.csv, 'w') as f:
+                f.write('t_us,red,ir\n')
+                for t_us, red, ir in capture.chunks():
+                    np.savetxt(f, np.column_stack((t_us, red, ir)), fmt='%d', delimiter=',')
+            print(f"✅ Exported to {args.csv}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
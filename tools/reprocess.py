@@ -0,0 +1,454 @@
+# reprocess.py - NumPy batch reprocessing of recorded PPG sessions
+# Runs on the PC, not the ESP32. From the project root:
+#
+#   python -m tools.reprocess recordings/ -o results/
+#   python -m tools.reprocess session.json -o results/ --verify
+#
+# Recordings can be .ppg raw captures (lib/ppg_capture.py), JSON objects
+# {"sample_rate": ..., "red": [...], "ir": [...]} or CSV files with red and ir
+# columns.
+#
+# Replays each recording through the same per-batch logic as the main.py
+# loop (add samples -> check_finger_present -> SignalQuality gate ->
+# calculate_heart_rate -> calculate_spo2) but with whole-recording NumPy array
+# operations instead of sample-by-sample Python. Every batch the device would
+# have produced becomes one JSON line in <out>/<session>.jsonl, and one
+# summary line per session is appended to <out>/summary.jsonl as soon as that
+# session finishes. Batches whose quality score is below QUALITY_THRESHOLD
+# are skipped like on the device: no HR/SpO2, running average untouched.
+#
+# Tolerance vs. the float reference in lib/heart_rate.py (--verify):
+#   heart_rate: within HR_TOLERANCE_BPM (float summation order can move the
+#               final int() truncation or a threshold comparison by one step)
+#   spo2:       within SPO2_TOLERANCE
+#   finger, quality: identical
+#
+# Tolerance vs. what the device runs - FixedPointHeartRateCalculator,
+# check_finger_present_buf, calculate_spo2_tenths and SignalQuality, with
+# nominal sample timestamps that wrap at 2**30 us like ticks_us() does, so
+# recordings longer than ~18 minutes exercise the wrap (--verify-device):
+#   heart_rate: within DEVICE_HR_TOLERANCE_BPM (integer filter/threshold
+#               rounding can move a peak by a sample)
+#   spo2:       within DEVICE_SPO2_TOLERANCE (tenths of a percent, DC >> 4)
+#   finger, quality: identical
+
+import argparse
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from array import array
+
+import numpy as np
+
+from lib.heart_rate import (TICKS_MASK, FixedPointHeartRateCalculator, HeartRateCalculator, SignalQuality,
+                            calculate_spo2, calculate_spo2_tenths, check_finger_present,
+                            check_finger_present_buf)
+from tools.ppg_reader import load_capture
+
+# Mirrors of the constants hard-coded in lib/heart_rate.py
+HR_WINDOW_SECONDS = 2       # calculate_heart_rate() uses the last 2 seconds
+FILTER_WINDOW = 5           # apply_bandpass_filter() moving average width
+MIN_PEAK_SECONDS = 0.5      # find_peaks() default min_distance
+THRESHOLD_STD_FACTOR = 0.5  # find_peaks() threshold = mean + 0.5 * std
+MIN_INTERVAL = 0.3          # seconds (200 BPM)
+MAX_INTERVAL = 2.0          # seconds (30 BPM)
+MAX_INTERVALS = 10          # running average length of BPM values
+FINGER_MIN_SAMPLES = 10
+FINGER_MIN_MEAN = 50000
+FINGER_MIN_STD = 1000
+QUALITY_THRESHOLD = 50      # main.py: batches scoring below skip HR/SpO2
+
+DEFAULT_SAMPLE_RATE = 25    # MAX30102 FIFO output: 100 Hz ADC, 4-sample averaging
+DEFAULT_BATCH_SIZE = 16     # main.py ACQ_DRAIN_SAMPLES: samples per FIFO drain
+
+HR_TOLERANCE_BPM = 1
+SPO2_TOLERANCE = 1e-6
+DEVICE_HR_TOLERANCE_BPM = 2
+DEVICE_SPO2_TOLERANCE = 0.2
+
+
+def _load_json(path):
+    with open(path) as f:
+        data = json.load(f)
+    return (np.asarray(data['red'], dtype=np.int64),
+            np.asarray(data['ir'], dtype=np.int64),
+            data.get('sample_rate'))
+
+
+def _load_csv(path):
+    with open(path) as f:
+        columns = [name.strip() for name in f.readline().split(',')]
+    data = np.loadtxt(path, delimiter=',', skiprows=1, dtype=np.int64, ndmin=2)
+    return data[:, columns.index('red')], data[:, columns.index('ir')], None
+
+
+# File extension -> loader returning (red, ir, sample_rate or None)
+LOADERS = {
+    '.json': _load_json,
+    '.csv': _load_csv,
+    '.ppg': load_capture,
+}
+
+
+def load_session(path):
+    """Load a recording as (red, ir, sample_rate) NumPy arrays"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in LOADERS:
+        raise ValueError(f"Unsupported recording format: {path}")
+    red, ir, sample_rate = LOADERS[ext](path)
+    if len(red) != len(ir):
+        raise ValueError(f"Red/IR length mismatch in {path}")
+    return red, ir, sample_rate
+
+
+def batch_starts(n_samples, batch_size):
+    """Start index of every loop batch (last batch may be short)"""
+    return np.arange(0, n_samples, batch_size, dtype=np.int64)
+
+
+def finger_present_batches(ir, starts, min_mean=FINGER_MIN_MEAN, min_std=FINGER_MIN_STD):
+    """Vectorized check_finger_present() for every batch"""
+    counts = np.diff(np.append(starts, len(ir)))
+    mean = np.add.reduceat(ir, starts) / counts
+    centered = ir - np.repeat(mean, counts)
+    std = np.sqrt(np.add.reduceat(centered * centered, starts) / counts)
+    return (counts >= FINGER_MIN_SAMPLES) & (mean >= min_mean) & (std > min_std)
+
+
+def quality_batches(ir, starts):
+    """Vectorized SignalQuality score for every batch, integer-exact"""
+    counts = np.diff(np.append(starts, len(ir)))
+    lo = np.minimum.reduceat(ir, starts)
+    hi = np.maximum.reduceat(ir, starts)
+    ac = hi - lo
+    dc = np.add.reduceat(ir, starts) // counts
+    clipping = (ir <= SignalQuality.CLIP_LOW) | (ir >= SignalQuality.CLIP_HIGH)
+    clipped = np.add.reduceat(clipping.astype(np.int64), starts)
+
+    # Second differences run across batch boundaries, as SignalQuality keeps
+    # its last two samples; the first two samples of a recording have none
+    jerk = np.zeros(len(ir), dtype=np.int64)
+    jerk[2:] = np.abs(ir[2:] - 2 * ir[1:-1] + ir[:-2])
+    has_jerk = np.zeros(len(ir), dtype=np.int64)
+    has_jerk[2:] = 1
+    jerk_sum = np.add.reduceat(jerk, starts)
+    jerk_n = np.add.reduceat(has_jerk, starts)
+
+    perfusion = np.where(dc > 0, ac * 1000 // np.maximum(dc, 1), 0)
+    perfusion_score = np.where(perfusion < SignalQuality.MIN_PERFUSION,
+                               perfusion * 100 // SignalQuality.MIN_PERFUSION,
+                               np.where(perfusion > SignalQuality.MAX_PERFUSION, 30, 100))
+    clip_score = 100 - clipped * 400 // counts
+    motion = np.where((ac > 0) & (jerk_n > 0), (jerk_sum // np.maximum(jerk_n, 1)) * 100 // np.maximum(ac, 1), 0)
+    motion_score = np.where(motion > SignalQuality.MOTION_FREE,
+                            100 - (motion - SignalQuality.MOTION_FREE) * 3, 100)
+    score = np.minimum(np.minimum(perfusion_score, clip_score), motion_score)
+    return np.maximum(score, 0)
+
+
+def spo2_batches(red, ir, starts):
+    """Vectorized calculate_spo2() for every batch"""
+    counts = np.diff(np.append(starts, len(ir)))
+    red_ac = np.maximum.reduceat(red, starts) - np.minimum.reduceat(red, starts)
+    ir_ac = np.maximum.reduceat(ir, starts) - np.minimum.reduceat(ir, starts)
+    red_dc = np.add.reduceat(red, starts) / counts
+    ir_dc = np.add.reduceat(ir, starts) / counts
+
+    valid = (counts >= 10) & (red_dc != 0) & (ir_dc != 0) & (ir_ac != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r_ratio = (red_ac / red_dc) / (ir_ac / ir_dc)
+    spo2 = np.where(r_ratio < 0.4, 100.0, np.where(r_ratio < 2.0, 110 - 25 * r_ratio, 60.0))
+    spo2 = np.clip(spo2, 85, 100)
+    return np.where(valid, spo2, 0.0)
+
+
+def filter_windows(windows, taps=FILTER_WINDOW):
+    """apply_bandpass_filter() on every row, including its shrinking edges"""
+    n = windows.shape[1]
+    cumsum = np.zeros((windows.shape[0], n + 1))
+    np.cumsum(windows, axis=1, out=cumsum[:, 1:])
+    idx = np.arange(n)
+    lo = np.maximum(0, idx - taps // 2)
+    hi = np.minimum(n, idx + taps // 2 + 1)
+    return (cumsum[:, hi] - cumsum[:, lo]) / (hi - lo)
+
+
+def raw_heart_rates(windows, sample_rate, min_distance=None):
+    """
+    Per-window BPM before smoothing (find_peaks + interval averaging)
+
+    Returns:
+        tuple: (bpm, valid) arrays; valid is False where the device
+               would have returned 0 without updating its running average
+    """
+    return peak_heart_rates(filter_windows(windows), sample_rate, min_distance)
+
+
+def peak_heart_rates(filtered, sample_rate, min_distance=None, threshold_factor=THRESHOLD_STD_FACTOR):
+    """raw_heart_rates() on already filtered windows"""
+    if min_distance is None:
+        min_distance = int(math.ceil(MIN_PEAK_SECONDS * sample_rate))
+    mean = filtered.mean(axis=1, keepdims=True)
+    std = np.sqrt(((filtered - mean) ** 2).mean(axis=1, keepdims=True))
+    threshold = mean + threshold_factor * std
+
+    candidates = np.zeros(filtered.shape, dtype=bool)
+    candidates[:, 1:-1] = ((filtered[:, 1:-1] > filtered[:, :-2]) &
+                           (filtered[:, 1:-1] > filtered[:, 2:]) &
+                           (filtered[:, 1:-1] > threshold))
+
+    # Greedy min-distance selection walks the window once, for all rows at once
+    rows = filtered.shape[0]
+    last_peak = np.full(rows, -min_distance, dtype=np.int64)
+    has_peak = np.zeros(rows, dtype=bool)
+    interval_sum = np.zeros(rows)
+    interval_count = np.zeros(rows, dtype=np.int64)
+    for i in np.flatnonzero(candidates.any(axis=0)):
+        accept = candidates[:, i] & (i - last_peak >= min_distance)
+        interval = (i - last_peak) / sample_rate
+        counted = accept & has_peak & (interval >= MIN_INTERVAL) & (interval <= MAX_INTERVAL)
+        interval_sum[counted] += interval[counted]
+        interval_count[counted] += 1
+        last_peak[accept] = i
+        has_peak |= accept
+
+    valid = interval_count > 0
+    bpm = np.zeros(rows)
+    bpm[valid] = 60 / (interval_sum[valid] / interval_count[valid])
+    return bpm, valid
+
+
+def smooth_heart_rates(bpm, max_intervals=MAX_INTERVALS):
+    """Running average over the last max_intervals BPM values, as int()"""
+    cumsum = np.concatenate(([0.0], np.cumsum(bpm)))
+    k = np.arange(1, len(bpm) + 1)
+    lo = np.maximum(0, k - max_intervals)
+    return ((cumsum[k] - cumsum[lo]) / (k - lo)).astype(np.int64)
+
+
+def process_recording(red, ir, sample_rate=DEFAULT_SAMPLE_RATE, batch_size=DEFAULT_BATCH_SIZE,
+                      quality_threshold=QUALITY_THRESHOLD):
+    """
+    Replay a whole recording through the main.py loop logic
+
+    Returns:
+        dict of per-batch arrays: end (sample index after the batch),
+        finger, quality, heart_rate, spo2
+    """
+    if len(ir) == 0:  # Nothing recorded: no batches, no results
+        empty = np.zeros(0, dtype=np.int64)
+        return {'end': empty, 'finger': np.zeros(0, dtype=bool), 'quality': empty,
+                'heart_rate': empty, 'spo2': np.zeros(0, dtype=np.float64)}
+
+    starts = batch_starts(len(ir), batch_size)
+    ends = np.append(starts[1:], len(ir))
+    finger = finger_present_batches(ir, starts)
+    quality = quality_batches(ir, starts)
+    measured = finger & (quality >= quality_threshold) if quality_threshold is not None else finger
+    spo2 = np.where(measured, spo2_batches(red, ir, starts), 0.0)
+
+    heart_rate = np.zeros(len(starts), dtype=np.int64)
+    window = int(HR_WINDOW_SECONDS * sample_rate)
+    computed = np.flatnonzero(measured & (ends >= window))
+    if len(computed):
+        windows = np.lib.stride_tricks.sliding_window_view(ir, window)[ends[computed] - window]
+        bpm, valid = raw_heart_rates(windows.astype(np.float64), sample_rate)
+        # Batches where no interval survived return 0 but keep the previous
+        # running average untouched, exactly like HeartRateCalculator
+        heart_rate[computed[valid]] = smooth_heart_rates(bpm[valid])
+
+    return {'end': ends, 'finger': finger, 'quality': quality, 'heart_rate': heart_rate, 'spo2': spo2}
+
+
+def reference_process(red, ir, sample_rate=DEFAULT_SAMPLE_RATE, batch_size=DEFAULT_BATCH_SIZE,
+                      quality_threshold=QUALITY_THRESHOLD):
+    """Replay a recording through lib/heart_rate.py sample by sample (slow)"""
+    calculator = HeartRateCalculator(sample_rate=sample_rate)
+    signal_quality = SignalQuality()
+    red = red.tolist()
+    ir = ir.tolist()
+    finger, quality, heart_rate, spo2 = [], [], [], []
+    for start in range(0, len(ir), batch_size):
+        red_data = red[start:start + batch_size]
+        ir_data = ir[start:start + batch_size]
+        signal_quality.begin()
+        for ir_val in ir_data:
+            calculator.add_sample(ir_val)
+            signal_quality.add(ir_val)
+        score = signal_quality.end()
+        present = check_finger_present(ir_data)
+        finger.append(present)
+        quality.append(score)
+        if present and (quality_threshold is None or score >= quality_threshold):
+            heart_rate.append(calculator.calculate_heart_rate())
+            spo2.append(calculate_spo2(red_data, ir_data))
+        else:
+            heart_rate.append(0)
+            spo2.append(0.0)
+    return {'finger': np.array(finger, dtype=bool),
+            'quality': np.array(quality, dtype=np.int64),
+            'heart_rate': np.array(heart_rate, dtype=np.int64),
+            'spo2': np.array(spo2, dtype=np.float64)}
+
+
+def device_process(red, ir, sample_rate=DEFAULT_SAMPLE_RATE, batch_size=DEFAULT_BATCH_SIZE,
+                   quality_threshold=QUALITY_THRESHOLD):
+    """Replay a recording through the integer pipeline main.py's Acquisition.step runs (slow)"""
+    calculator = FixedPointHeartRateCalculator(sample_rate=sample_rate)
+    signal_quality = SignalQuality()
+    period_us = int(1000000 / sample_rate)
+    red_buf = array('i', [0] * batch_size)
+    ir_buf = array('i', [0] * batch_size)
+    ts_buf = array('i', [0] * batch_size)
+    red = red.tolist()
+    ir = ir.tolist()
+    finger, quality, heart_rate, spo2 = [], [], [], []
+    for start in range(0, len(ir), batch_size):
+        n = min(batch_size, len(ir) - start)
+        signal_quality.begin()
+        for i in range(n):
+            red_buf[i] = red[start + i]
+            ir_buf[i] = ir[start + i]
+            ts_buf[i] = ((start + i) * period_us) & TICKS_MASK  # wraps like ticks_us()
+            signal_quality.add(ir_buf[i])
+        score = signal_quality.end()
+        calculator.add_samples(ir_buf, n, ts_buf)
+        present = check_finger_present_buf(ir_buf, n)
+        finger.append(present)
+        quality.append(score)
+        if present and (quality_threshold is None or score >= quality_threshold):
+            heart_rate.append(calculator.calculate_heart_rate())
+            spo2.append(calculate_spo2_tenths(red_buf, ir_buf, n) / 10)
+        else:
+            heart_rate.append(0)
+            spo2.append(0.0)
+    return {'finger': np.array(finger, dtype=bool),
+            'quality': np.array(quality, dtype=np.int64),
+            'heart_rate': np.array(heart_rate, dtype=np.int64),
+            'spo2': np.array(spo2, dtype=np.float64)}
+
+
+def compare_with_reference(result, reference, hr_tolerance=HR_TOLERANCE_BPM, spo2_tolerance=SPO2_TOLERANCE):
+    """Max deviations between the NumPy engine and a sample-by-sample replay"""
+    hr_diff = int(np.abs(result['heart_rate'] - reference['heart_rate']).max(initial=0))
+    spo2_diff = float(np.abs(result['spo2'] - reference['spo2']).max(initial=0))
+    finger_mismatch = int((result['finger'] != reference['finger']).sum())
+    quality_mismatch = int((result['quality'] != reference['quality']).sum())
+    return {
+        'max_hr_diff': hr_diff,
+        'max_spo2_diff': spo2_diff,
+        'finger_mismatches': finger_mismatch,
+        'quality_mismatches': quality_mismatch,
+        'within_tolerance': (hr_diff <= hr_tolerance and
+                             spo2_diff <= spo2_tolerance and
+                             finger_mismatch == 0 and
+                             quality_mismatch == 0),
+    }
+
+
+def process_file(path, out_dir, sample_rate=None, batch_size=DEFAULT_BATCH_SIZE, verify=False,
+                 verify_device=False):
+    """Worker: reprocess one recording and write its per-batch results"""
+    started = time.perf_counter()
+    red, ir, file_rate = load_session(path)
+    rate = sample_rate or file_rate or DEFAULT_SAMPLE_RATE
+    result = process_recording(red, ir, rate, batch_size)
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    out_path = os.path.join(out_dir, name + '.jsonl')
+    with open(out_path, 'w') as f:
+        for end, finger, quality, hr, spo2 in zip(result['end'].tolist(), result['finger'].tolist(),
+                                                  result['quality'].tolist(), result['heart_rate'].tolist(),
+                                                  result['spo2'].tolist()):
+            f.write(json.dumps({'sample': end, 'finger': finger, 'quality': quality,
+                                'heart_rate': hr, 'spo2': round(spo2, 3)}) + '\n')
+
+    valid_hr = result['heart_rate'][(result['heart_rate'] >= 30) & (result['heart_rate'] <= 200)]
+    summary = {
+        'session': name,
+        'path': path,
+        'output': out_path,
+        'sample_rate': rate,
+        'samples': int(len(ir)),
+        'batches': int(len(result['end'])),
+        'finger_batches': int(result['finger'].sum()),
+        'low_quality_batches': int((result['finger'] & (result['quality'] < QUALITY_THRESHOLD)).sum()),
+        'valid_hr_batches': int(len(valid_hr)),
+        'mean_heart_rate': round(float(valid_hr.mean()), 1) if len(valid_hr) else None,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+    if verify:
+        summary['verify'] = compare_with_reference(result, reference_process(red, ir, rate, batch_size))
+    if verify_device:
+        summary['verify_device'] = compare_with_reference(result, device_process(red, ir, rate, batch_size),
+                                                          DEVICE_HR_TOLERANCE_BPM, DEVICE_SPO2_TOLERANCE)
+    return summary
+
+
+def find_recordings(paths):
+    """Expand files and directories into a sorted list of recordings"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for entry in sorted(os.listdir(path)):
+                if os.path.splitext(entry)[1].lower() in LOADERS:
+                    found.append(os.path.join(path, entry))
+        else:
+            found.append(path)
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocess recorded PPG sessions with NumPy")
+    parser.add_argument('inputs', nargs='+', help="recording files or directories")
+    parser.add_argument('-o', '--out', default='results', help="output directory")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--sample-rate', type=float, default=None,
+                        help=f"override sample rate (default: from file, else {DEFAULT_SAMPLE_RATE})")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="samples per simulated loop iteration")
+    parser.add_argument('--verify', action='store_true',
+                        help="also run the lib/heart_rate.py float reference and report deviations")
+    parser.add_argument('--verify-device', action='store_true',
+                        help="also run the fixed-point pipeline the device runs and report deviations")
+    args = parser.parse_args(argv)
+
+    recordings = find_recordings(args.inputs)
+    if not recordings:
+        print("❌ No recordings found")
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+
+    print(f"🔄 Reprocessing {len(recordings)} sessions...")
+    failed = 0
+    summary_path = os.path.join(args.out, 'summary.jsonl')
+    with open(summary_path, 'w') as summary_file, ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(process_file, path, args.out, args.sample_rate,
+                               args.batch_size, args.verify, args.verify_device): path for path in recordings}
+        for future in as_completed(futures):
+            try:
+                summary = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"❌ {futures[future]}: {e}")
+                continue
+            summary_file.write(json.dumps(summary) + '\n')
+            summary_file.flush()
+            line = f"✅ {summary['session']}: {summary['batches']} batches in {summary['seconds']}s"
+            for name in ('verify', 'verify_device'):
+                if name in summary:
+                    check = summary[name]
+                    mark = "match" if check['within_tolerance'] else "MISMATCH"
+                    line += (f" | {name.replace('_', ' ')} {mark} "
+                             f"(ΔHR {check['max_hr_diff']}, ΔSpO2 {check['max_spo2_diff']:.2g})")
+            print(line)
+
+    print(f"📁 Summary written to {summary_path}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
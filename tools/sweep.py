@@ -0,0 +1,454 @@
+# sweep.py - Parallel parameter sweep of the heart-rate pipeline
+# Runs on the PC, not the ESP32. From the project root:
+#
+#   python -m tools.sweep recordings/ --synthetic 8 -o sweep.jsonl
+#   python -m tools.sweep --synthetic 16 --window 1.5,2,3 --taps 3,5
+#
+# Replays every session (recordings as accepted by tools.reprocess, and/or
+# generated ones with known ground truth) through the tools.reprocess engine
+# for every combination of the HeartRateCalculator / check_finger_present
+# constants, and reports the Pareto front of per-loop CPU cost against BPM
+# error. Generated sessions and the simulated drains default to what the
+# device runs (DEFAULT_SAMPLE_RATE, DEFAULT_BATCH_SIZE from tools.reprocess),
+# and a batch only gets a BPM if it passes the same SignalQuality gate. If no
+# parameter set reaches --min-coverage, the front is taken over the sets
+# within FALLBACK_COVERAGE of the best coverage instead.
+#
+# Time parameters (window, min_distance) are swept, keyed and reported in
+# seconds, so sessions recorded at different rates aggregate into one row;
+# each session converts them to samples at its own rate. buffer_size is not
+# swept: the engine only ever looks at the last window, so it changes RAM
+# and nothing else. RAM is reported for the device's BUFFER_SECONDS.
+#
+# Work is split into one task per (session, window, filter taps), fanned out
+# over a process pool. Inside a task the filtered windows are computed once
+# and shared by every threshold / min_distance / max_intervals / finger
+# combination. Decoded sessions and their ground truth are cached per session
+# in --cache, so repeated sweeps skip decoding and reference estimation.
+#
+# Ground truth:
+#   synthetic   the generator's instantaneous BPM and finger on/off mask
+#   recordings  a spectral BPM estimate over REFERENCE_SECONDS of IR,
+#               independent of the peak detector being swept; finger errors
+#               are not scored
+#
+# CPU cost is counted, not timed (timings under a busy process pool mean
+# little for an ESP32): inner-loop iterations per main.py loop for
+# FixedPointHeartRateCalculator and the per-batch checks:
+#   add_samples + finger + spo2   3 * batch
+#   calculate_heart_rate          window * (taps + 4)   copy, filter, mean/var, peaks
+# with window in samples at each session's rate; a row reports the mean over
+# its sessions.
+
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+
+import numpy as np
+
+from tools.reprocess import (DEFAULT_BATCH_SIZE, DEFAULT_SAMPLE_RATE, FILTER_WINDOW, FINGER_MIN_MEAN,
+                             FINGER_MIN_STD, HR_WINDOW_SECONDS, MAX_INTERVALS, MIN_PEAK_SECONDS,
+                             QUALITY_THRESHOLD, THRESHOLD_STD_FACTOR, batch_starts, filter_windows,
+                             find_recordings, finger_present_batches, load_session, peak_heart_rates,
+                             quality_batches, smooth_heart_rates)
+
+SYNTHETIC_PREFIX = 'synthetic:'
+SYNTHETIC_SECONDS = 300
+REFERENCE_SECONDS = 8       # spectral reference window for recordings
+REFERENCE_MIN_BPM = 40
+REFERENCE_MAX_BPM = 200
+REFERENCE_MIN_PEAK_RATIO = 4  # peak power vs. mean in-band power
+MIN_COVERAGE = 0.5          # share of finger batches that must get a BPM
+FALLBACK_COVERAGE = 0.9     # no row reached MIN_COVERAGE: front within this share of the best
+BUFFER_SECONDS = 5          # FixedPointHeartRateCalculator buffer_size
+CACHE_VERSION = 2
+
+# Device values first in every default grid
+DEFAULT_GRID = {
+    'window_seconds': [HR_WINDOW_SECONDS, 1.5, 3, 4],
+    'min_distance_seconds': [MIN_PEAK_SECONDS, 0.33, 0.4],
+    'threshold_factor': [THRESHOLD_STD_FACTOR, 0, 0.25, 0.75],
+    'taps': [FILTER_WINDOW, 3, 7, 9],
+    'max_intervals': [MAX_INTERVALS, 1, 5, 20],
+    'finger_min_mean': [FINGER_MIN_MEAN, 30000],
+    'finger_min_std': [FINGER_MIN_STD, 300, 3000],
+    'quality_threshold': [QUALITY_THRESHOLD],
+}
+
+
+def synthesize_session(seed, seconds=SYNTHETIC_SECONDS, sample_rate=DEFAULT_SAMPLE_RATE):
+    """
+    Generate a PPG session with known truth
+
+    The BPM wanders between 50 and 160 in 10 s steps; the session also has
+    off-finger gaps, respiration and drift on the DC level, sensor noise and
+    motion bursts.
+
+    Returns:
+        tuple: (red, ir, truth_bpm, truth_finger) per-sample arrays
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sample_rate)
+    t = np.arange(n) / sample_rate
+
+    knots = np.arange(0, seconds + 10, 10)
+    walk = np.clip(rng.uniform(60, 110) + np.cumsum(rng.normal(0, 10, len(knots))), 50, 160)
+    bpm = np.interp(t, knots, walk)
+
+    phase = np.cumsum(bpm / 60 / sample_rate) % 1.0
+    pulse = np.exp(-((phase - 0.15) / 0.07) ** 2) + 0.35 * np.exp(-((phase - 0.45) / 0.1) ** 2)
+    pulse -= pulse.mean()
+
+    ir_dc = rng.uniform(80000, 160000) * (1 + 0.02 * np.sin(2 * np.pi * 0.25 * t)
+                                         + 0.05 * np.sin(2 * np.pi * t / seconds))
+    perfusion = rng.uniform(0.01, 0.04)
+    ratio = rng.uniform(0.5, 0.9)  # red/IR modulation ratio (SpO2 ~ 88-97%)
+    ir = ir_dc * (1 + perfusion * pulse)
+    red = 0.8 * ir_dc * (1 + ratio * perfusion * pulse)
+
+    # Motion: a few bursts of large random-walk artifacts
+    for _ in range(rng.integers(1, 4)):
+        start = rng.integers(0, n - 5 * sample_rate)
+        length = int(rng.uniform(2, 5) * sample_rate)
+        artifact = np.cumsum(rng.normal(0, 0.004, length)) * ir_dc[start]
+        ir[start:start + length] += artifact
+        red[start:start + length] += 0.8 * artifact
+
+    # Finger lifted: ambient-light level only
+    finger = np.ones(n, dtype=bool)
+    for _ in range(rng.integers(1, 3)):
+        start = rng.integers(0, n - 15 * sample_rate)
+        finger[start:start + int(rng.uniform(5, 15) * sample_rate)] = False
+    ir[~finger] = rng.uniform(500, 3000)
+    red[~finger] = rng.uniform(500, 3000)
+
+    ir += rng.normal(0, 40, n)
+    red += rng.normal(0, 40, n)
+    red = np.clip(red, 0, 0x3FFFF).astype(np.int64)
+    ir = np.clip(ir, 0, 0x3FFFF).astype(np.int64)
+    return red, ir, bpm, finger
+
+
+def spectral_reference(ir, ends, sample_rate, seconds=REFERENCE_SECONDS):
+    """
+    Independent BPM estimate at every batch end: dominant in-band frequency
+    of the last `seconds` of IR (NaN where too early or no clear peak)
+    """
+    length = int(seconds * sample_rate)
+    truth = np.full(len(ends), np.nan)
+    usable = np.flatnonzero(ends >= length)
+    if len(usable) == 0:
+        return truth
+    windows = np.lib.stride_tricks.sliding_window_view(ir.astype(np.float64), length)[ends[usable] - length]
+    windows = (windows - windows.mean(axis=1, keepdims=True)) * np.hanning(length)
+    n_fft = max(8192, 1 << int(math.ceil(math.log2(length))))
+    power = np.abs(np.fft.rfft(windows, n=n_fft, axis=1)) ** 2
+    freqs = np.fft.rfftfreq(n_fft, 1 / sample_rate) * 60
+    band = (freqs >= REFERENCE_MIN_BPM) & (freqs <= REFERENCE_MAX_BPM)
+    band_power = power[:, band]
+    peak = band_power.argmax(axis=1)
+    clear = band_power.max(axis=1) >= REFERENCE_MIN_PEAK_RATIO * band_power.mean(axis=1)
+    truth[usable[clear]] = freqs[band][peak[clear]]
+    return truth
+
+
+def _cache_path(cache_dir, spec, sample_rate, batch_size):
+    if spec.startswith(SYNTHETIC_PREFIX):
+        key = spec
+    else:
+        stat = os.stat(spec)
+        key = f"{os.path.abspath(spec)}:{stat.st_size}:{stat.st_mtime_ns}"
+    key = f"{CACHE_VERSION}:{key}:{sample_rate}:{batch_size}"
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest()[:16] + '.npz')
+
+
+def prepare_session(spec, sample_rate, batch_size, cache_dir=None):
+    """
+    Decode a session and its per-batch ground truth (cached on disk)
+
+    Returns:
+        dict: red, ir, sample_rate, ends, truth_bpm (NaN = unknown) and
+              truth_finger (None for recordings)
+    """
+    path = _cache_path(cache_dir, spec, sample_rate, batch_size) if cache_dir else None
+    if path and os.path.exists(path):
+        with np.load(path) as cached:
+            session = {key: cached[key] for key in cached.files}
+        session['sample_rate'] = float(session['sample_rate'])
+        session['truth_finger'] = session['truth_finger'] if session['has_finger_truth'] else None
+        return session
+
+    if spec.startswith(SYNTHETIC_PREFIX):
+        rate = sample_rate or DEFAULT_SAMPLE_RATE
+        red, ir, bpm, finger = synthesize_session(int(spec[len(SYNTHETIC_PREFIX):]), sample_rate=rate)
+        starts = batch_starts(len(ir), batch_size)
+        ends = np.append(starts[1:], len(ir))
+        truth_bpm = bpm[ends - 1]
+        truth_finger = np.logical_and.reduceat(finger, starts)
+    else:
+        red, ir, file_rate = load_session(spec)
+        rate = sample_rate or file_rate or DEFAULT_SAMPLE_RATE
+        starts = batch_starts(len(ir), batch_size)
+        ends = np.append(starts[1:], len(ir))
+        truth_bpm = spectral_reference(ir, ends, rate)
+        truth_finger = None
+
+    session = {'red': red, 'ir': ir, 'sample_rate': rate, 'ends': ends,
+               'truth_bpm': truth_bpm, 'truth_finger': truth_finger}
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(path + '.tmp.npz', red=red, ir=ir, sample_rate=rate, ends=ends, truth_bpm=truth_bpm,
+                 truth_finger=truth_finger if truth_finger is not None else np.zeros(0, dtype=bool),
+                 has_finger_truth=truth_finger is not None)
+        os.replace(path + '.tmp.npz', path)
+    return session
+
+
+@lru_cache(maxsize=8)
+def _worker_session(spec, sample_rate, batch_size, cache_dir):
+    """Per-process memo: a worker handling several tasks of one session decodes it once"""
+    return prepare_session(spec, sample_rate, batch_size, cache_dir)
+
+
+@lru_cache(maxsize=64)
+def _worker_finger(spec, sample_rate, batch_size, cache_dir, min_mean, min_std):
+    session = _worker_session(spec, sample_rate, batch_size, cache_dir)
+    starts = batch_starts(len(session['ir']), batch_size)
+    return finger_present_batches(session['ir'], starts, min_mean, min_std)
+
+
+@lru_cache(maxsize=8)
+def _worker_quality(spec, sample_rate, batch_size, cache_dir):
+    session = _worker_session(spec, sample_rate, batch_size, cache_dir)
+    starts = batch_starts(len(session['ir']), batch_size)
+    return quality_batches(session['ir'], starts)
+
+
+def loop_cost(window, taps, batch_size):
+    """Inner-loop iterations per main.py loop (see header)"""
+    return 3 * batch_size + window * (taps + 4)
+
+
+def ram_bytes(buffer_size, window, max_intervals):
+    """FixedPointHeartRateCalculator array storage"""
+    return 8 * buffer_size + 12 * window + 4 * max_intervals
+
+
+def score(heart_rate, finger, session):
+    """Error counts for one parameter set on one session"""
+    truth_bpm = session['truth_bpm']
+    truth_finger = session['truth_finger']
+    estimated = (heart_rate >= 30) & (heart_rate <= 200)
+    known = ~np.isnan(truth_bpm)
+    if truth_finger is not None:
+        known &= truth_finger
+    hit = estimated & known
+    counts = {
+        'truth_batches': int(known.sum()),
+        'estimated': int(hit.sum()),
+        'abs_error_sum': float(np.abs(heart_rate[hit] - truth_bpm[hit]).sum()),
+        'false_hr': 0,
+        'finger_errors': 0,
+    }
+    if truth_finger is not None:
+        counts['false_hr'] = int((estimated & ~truth_finger).sum())
+        counts['finger_errors'] = int((finger != truth_finger).sum())
+    return counts
+
+
+def sweep_task(spec, sample_rate, batch_size, cache_dir, window_seconds, taps, grid):
+    """
+    Worker: every combination sharing one session, window and filter width
+
+    Returns:
+        list of (params, counts) tuples
+    """
+    session = _worker_session(spec, sample_rate, batch_size, cache_dir)
+    rate = session['sample_rate']
+    ir = session['ir']
+    ends = session['ends']
+    window = int(window_seconds * rate)
+    if window_seconds > BUFFER_SECONDS:
+        return []  # calculate_heart_rate() could never fill its window
+
+    computed = np.flatnonzero(ends >= window)
+    if len(computed) and window >= rate:  # find_peaks() needs a second of data
+        windows = np.lib.stride_tricks.sliding_window_view(ir, window)[ends[computed] - window]
+        filtered = filter_windows(windows.astype(np.float64), taps)
+    else:
+        computed = computed[:0]
+
+    quality = _worker_quality(spec, sample_rate, batch_size, cache_dir)
+    results = []
+    for factor, min_distance_seconds in itertools.product(grid['threshold_factor'],
+                                                          grid['min_distance_seconds']):
+        min_distance = int(math.ceil(min_distance_seconds * rate))
+        if len(computed):
+            bpm, valid = peak_heart_rates(filtered, rate, min_distance, factor)
+        for min_mean, min_std, quality_threshold in itertools.product(
+                grid['finger_min_mean'], grid['finger_min_std'], grid['quality_threshold']):
+            finger = _worker_finger(spec, sample_rate, batch_size, cache_dir, min_mean, min_std)
+            measured = finger & (quality >= quality_threshold)
+            for max_intervals in grid['max_intervals']:
+                heart_rate = np.zeros(len(ends), dtype=np.int64)
+                if len(computed):
+                    # Same bookkeeping and SignalQuality gate as tools.reprocess.process_recording
+                    used = measured[computed] & valid
+                    heart_rate[computed[used]] = smooth_heart_rates(bpm[used], max_intervals)
+                counts = score(heart_rate, finger, session)
+                counts['sessions'] = 1
+                counts['cost_sum'] = loop_cost(window, taps, batch_size)
+                counts['ram_sum'] = ram_bytes(int(BUFFER_SECONDS * rate), window, max_intervals)
+                params = {
+                    'window_seconds': window_seconds,
+                    'min_distance_seconds': min_distance_seconds,
+                    'threshold_factor': factor,
+                    'taps': taps,
+                    'max_intervals': max_intervals,
+                    'finger_min_mean': min_mean,
+                    'finger_min_std': min_std,
+                    'quality_threshold': quality_threshold,
+                }
+                results.append((params, counts))
+    return results
+
+
+def pareto_front(rows, min_coverage=MIN_COVERAGE):
+    """Rows not beaten on both cost and error by a cheaper row (RAM breaks ties)"""
+    eligible = [row for row in rows if row['coverage'] >= min_coverage]
+    eligible.sort(key=lambda row: (row['cost'], row['mae'], row['ram']))
+    front = []
+    best = math.inf
+    for row in eligible:
+        if row['mae'] < best:
+            front.append(row)
+            best = row['mae']
+    return front
+
+
+def _parse_list(text, kind=float):
+    return [kind(value) for value in text.split(',') if value.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep heart-rate parameters over PPG sessions")
+    parser.add_argument('inputs', nargs='*', help="recording files or directories")
+    parser.add_argument('--synthetic', type=int, default=0, help="add N generated sessions with known truth")
+    parser.add_argument('-o', '--out', default='sweep.jsonl', help="every parameter set with its metrics")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--cache', default='.sweep_cache', help="per-session cache directory ('' disables)")
+    parser.add_argument('--sample-rate', type=float, default=None,
+                        help=f"override sample rate (default: from file; synthetic and unknown {DEFAULT_SAMPLE_RATE})")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"samples per simulated FIFO drain (default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument('--min-coverage', type=float, default=MIN_COVERAGE,
+                        help="minimum share of finger batches with a BPM to make the front")
+    options = {
+        'window_seconds': ('--window', float, "analysis window in seconds"),
+        'min_distance_seconds': ('--min-distance', float, "minimum peak spacing in seconds"),
+        'threshold_factor': ('--threshold', float, "peak threshold = mean + factor * std"),
+        'taps': ('--taps', int, "moving-average filter width (odd)"),
+        'max_intervals': ('--max-intervals', int, "BPM running-average length"),
+        'finger_min_mean': ('--finger-mean', float, "check_finger_present minimum mean"),
+        'finger_min_std': ('--finger-std', float, "check_finger_present minimum std"),
+        'quality_threshold': ('--quality', int, "SignalQuality score below which HR is skipped"),
+    }
+    for name, (flag, kind, text) in options.items():
+        default = ','.join(str(value) for value in DEFAULT_GRID[name])
+        parser.add_argument(flag, dest=name, default=default, help=f"{text} (default: {default})")
+    args = parser.parse_args(argv)
+    grid = {name: _parse_list(getattr(args, name), kind) for name, (_, kind, _) in options.items()}
+
+    sessions = find_recordings(args.inputs) + [f"{SYNTHETIC_PREFIX}{i}" for i in range(args.synthetic)]
+    if not sessions:
+        print("❌ No sessions: give recordings and/or --synthetic N")
+        return 1
+    cache_dir = args.cache or None
+
+    tasks = [(spec, window_seconds, taps) for spec in sessions
+             for window_seconds in grid['window_seconds'] for taps in grid['taps']]
+    print(f"🔄 Sweeping {len(sessions)} sessions in {len(tasks)} tasks...")
+    started = time.perf_counter()
+
+    totals = {}  # params key -> (params, summed counts)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(sweep_task, spec, args.sample_rate, args.batch_size, cache_dir,
+                               window_seconds, taps, grid): spec
+                   for spec, window_seconds, taps in tasks}
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"❌ {futures[future]}: {e}")
+                continue
+            for params, counts in results:
+                key = tuple(sorted(params.items()))
+                if key not in totals:
+                    totals[key] = (params, dict.fromkeys(counts, 0))
+                summed = totals[key][1]
+                for name, value in counts.items():
+                    summed[name] += value
+
+    rows = []
+    for params, counts in totals.values():
+        rows.append({
+            **params,
+            'cost': counts['cost_sum'] / counts['sessions'],
+            'ram': counts['ram_sum'] / counts['sessions'],
+            'mae': counts['abs_error_sum'] / counts['estimated'] if counts['estimated'] else math.inf,
+            'coverage': counts['estimated'] / counts['truth_batches'] if counts['truth_batches'] else 0.0,
+            'false_hr': counts['false_hr'],
+            'finger_errors': counts['finger_errors'],
+        })
+    min_coverage = args.min_coverage
+    front = pareto_front(rows, min_coverage)
+    if not front and rows:
+        best = max(row['coverage'] for row in rows)
+        print(f"⚠️  No parameter set reached {min_coverage:.0%} coverage (best {best:.1%}); "
+              f"relaxing to {FALLBACK_COVERAGE:.0%} of the best")
+        min_coverage = FALLBACK_COVERAGE * best
+        front = pareto_front(rows, min_coverage)
+    on_front = {id(row) for row in front}
+
+    with open(args.out, 'w') as f:
+        for row in sorted(rows, key=lambda row: (row['cost'], row['mae'])):
+            f.write(json.dumps({**row, 'cost': round(row['cost'], 1), 'ram': round(row['ram']),
+                                'mae': None if math.isinf(row['mae']) else round(row['mae'], 3),
+                                'coverage': round(row['coverage'], 4), 'pareto': id(row) in on_front}) + '\n')
+
+    print(f"✅ {len(rows)} parameter sets in {time.perf_counter() - started:.1f}s")
+    if front:
+        print(f"📈 Pareto front (coverage ≥ {min_coverage:.0%}):")
+        print("   cost   MAE  cover window_s taps min_d_s thresh max_int   ram finger(mean/std) false_hr")
+        for row in front:
+            print(f"   {row['cost']:5.0f} {row['mae']:5.2f} {row['coverage']:6.1%} {row['window_seconds']:8.2f} "
+                  f"{row['taps']:4d} {row['min_distance_seconds']:7.2f} {row['threshold_factor']:6.2f} "
+                  f"{row['max_intervals']:7d} {row['ram']:5.0f} "
+                  f"{row['finger_min_mean']:.0f}/{row['finger_min_std']:.0f} {row['false_hr']:8d}")
+        print(f"   (ram: {BUFFER_SECONDS} s buffer at each session's rate; buffer_size doesn't change any score)")
+    else:
+        print("⚠️  No parameter set produced a BPM")
+
+    current = [row for row in rows if row['window_seconds'] == HR_WINDOW_SECONDS
+               and row['taps'] == FILTER_WINDOW and row['threshold_factor'] == THRESHOLD_STD_FACTOR
+               and row['max_intervals'] == MAX_INTERVALS and row['finger_min_mean'] == FINGER_MIN_MEAN
+               and row['finger_min_std'] == FINGER_MIN_STD and row['min_distance_seconds'] == MIN_PEAK_SECONDS
+               and row['quality_threshold'] == QUALITY_THRESHOLD]
+    if current:
+        row = current[0]
+        print(f"📌 Current device settings ({args.batch_size} samples/drain): cost {row['cost']:.0f}, "
+              f"MAE {row['mae']:.2f} BPM, coverage {row['coverage']:.1%}")
+    print(f"📁 All results written to {args.out}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())